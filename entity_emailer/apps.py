@@ -1,6 +1,19 @@
 from django.apps import AppConfig
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
 
 
 class EntityEmailerConfig(AppConfig):
     name = 'entity_emailer'
     verbose_name = 'Django Entity Emailer'
+
+    def ready(self):
+        from entity_event.models import Medium, Source
+
+        from entity_emailer.utils import clear_cache
+
+        # Clear the cached medium, admin source and settings whenever they may have changed
+        for model in (Medium, Source):
+            post_save.connect(clear_cache, sender=model, dispatch_uid='entity_emailer_clear_cache')
+            post_delete.connect(clear_cache, sender=model, dispatch_uid='entity_emailer_clear_cache')
+        setting_changed.connect(clear_cache, dispatch_uid='entity_emailer_clear_cache')
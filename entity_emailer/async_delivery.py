@@ -0,0 +1,94 @@
+import asyncio
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail.message import sanitize_address
+
+try:
+    import aiosmtplib
+except ImportError:  # pragma: no cover
+    aiosmtplib = None
+
+
+class AsyncConnectionPool(object):
+    """
+    A bounded pool of connections to the SMTP server of the EMAIL_* settings that messages are sent over
+    concurrently with asyncio, so that one slow message does not hold up the others.
+
+    The pool is used as a context manager from synchronous code. It runs on its own event loop, and its
+    connections are opened as they are needed and stay open until the pool is closed.
+    """
+    def __init__(self, size=1, **smtp_kwargs):
+        if aiosmtplib is None:
+            raise ImproperlyConfigured('aiosmtplib must be installed to deliver emails asynchronously')
+
+        self.size = size
+        self.smtp_kwargs = {
+            'hostname': settings.EMAIL_HOST,
+            'port': settings.EMAIL_PORT,
+            'username': settings.EMAIL_HOST_USER or None,
+            'password': settings.EMAIL_HOST_PASSWORD or None,
+            'use_tls': settings.EMAIL_USE_SSL,
+            'start_tls': settings.EMAIL_USE_TLS,
+            'timeout': settings.EMAIL_TIMEOUT,
+        }
+        self.smtp_kwargs.update(smtp_kwargs)
+        self.clients = []
+        self.loop = None
+
+    def __enter__(self):
+        self.loop = asyncio.new_event_loop()
+        self.clients = [aiosmtplib.SMTP(**self.smtp_kwargs) for _ in range(self.size)]
+        return self
+
+    def __exit__(self, *args):
+        try:
+            self.loop.run_until_complete(self.close())
+        finally:
+            self.loop.close()
+
+    async def close(self):
+        for client in self.clients:
+            if client.is_connected:
+                try:
+                    await client.quit()
+                except aiosmtplib.SMTPException:
+                    client.close()
+
+    def deliver_messages(self, messages):
+        """
+        Blocks until the messages have been sent over the connections of the pool.
+
+        :return: A list with the exception raised for each message, or None if the message was sent
+        """
+        return self.loop.run_until_complete(self.deliver_messages_async(messages))
+
+    async def deliver_messages_async(self, messages):
+        """
+        Sends the messages concurrently over the connections of the pool. Each connection sends the messages
+        that it takes from a shared queue one at a time, and is reconnected if a message finds it disconnected.
+        """
+        exceptions = [None] * len(messages)
+        to_deliver = asyncio.Queue()
+        for i, message in enumerate(messages):
+            to_deliver.put_nowait((i, message))
+
+        async def deliver(client):
+            while not to_deliver.empty():
+                i, message = to_deliver.get_nowait()
+                try:
+                    if not client.is_connected:
+                        await client.connect()
+                    await client.send_message(
+                        message.message(),
+                        sender=sanitize_address(message.from_email, message.encoding or settings.DEFAULT_CHARSET),
+                        recipients=[
+                            sanitize_address(address, message.encoding or settings.DEFAULT_CHARSET)
+                            for address in message.recipients()
+                        ],
+                    )
+                except Exception as e:
+                    exceptions[i] = e
+
+        await asyncio.gather(*(deliver(client) for client in self.clients[:len(messages)]))
+        return exceptions
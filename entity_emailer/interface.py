@@ -1,18 +1,31 @@
-from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import copy
+from datetime import datetime, timedelta
 import json
+from queue import Empty, SimpleQueue
 import sys
+import time
 import traceback
 
 from ambition_utils.transaction import durable
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.core import mail
-from django.db import transaction
+from django.db import connections, transaction
+from django.db.models import Q
 from entity_event import context_loader
+from entity_event.models import Event, Subscription, Unsubscription
 
+from entity_emailer.async_delivery import AsyncConnectionPool
+from entity_emailer.metrics import SendMetrics
 from entity_emailer.models import Email
-from entity_emailer.signals import pre_send, email_exception
+from entity_emailer.rate_limit import RateLimiter
+from entity_emailer.signals import pre_send, email_exception, send_metrics
 from entity_emailer.utils import get_medium, get_from_email_address, get_subscribed_email_addresses, \
-    create_email_message, extract_email_subject_from_html_content
+    prefetch_subscribed_email_addresses, create_email_message, extract_email_subject_from_html_content, \
+    get_retry_delay, get_content_size
 
 
 class EntityEmailerInterface(object):
@@ -22,59 +35,289 @@ class EntityEmailerInterface(object):
 
     @classmethod
     @durable
-    def send_unsent_scheduled_emails(cls):
+    def send_unsent_scheduled_emails(cls, batch_size=None, num_workers=None, use_async=None):
         """
         Send out any scheduled emails that are unsent
+
+        :param batch_size: The maximum number of emails to fetch, render and send at a time. Falls back to the
+            ENTITY_EMAILER_SEND_BATCH_SIZE setting and defaults to 500, so that the memory used by a run does not
+            grow with the number of due emails.
+        :param num_workers: The number of threads, each with its own backend connection, that deliver the
+            rendered messages. Falls back to the ENTITY_EMAILER_SEND_WORKERS setting and defaults to 1.
+        :param use_async: Deliver the rendered messages with asyncio over a pool of num_workers SMTP connections
+            rather than with the email backend. Falls back to the ENTITY_EMAILER_ASYNC_DELIVERY setting and
+            requires aiosmtplib.
+        :return: The number of emails that were claimed to be sent
+        """
+        with ExitStack() as stack:
+            connections = cls.open_connections(stack, num_workers, use_async)
+            return cls.send_due_emails(connections, batch_size)
+
+    @staticmethod
+    def open_connections(stack, num_workers=None, use_async=None):
+        """
+        Opens the connections that messages are delivered over and registers them to be closed with the exit stack.
+        See send_unsent_scheduled_emails for the arguments.
+
+        :return: A list of email backend connections or an AsyncConnectionPool
+        """
+        num_workers = num_workers or getattr(settings, 'ENTITY_EMAILER_SEND_WORKERS', 1)
+        if use_async is None:
+            use_async = getattr(settings, 'ENTITY_EMAILER_ASYNC_DELIVERY', False)
+
+        if use_async:
+            return stack.enter_context(AsyncConnectionPool(num_workers))
+        return [stack.enter_context(mail.get_connection()) for _ in range(num_workers)]
+
+    @classmethod
+    def send_due_emails(cls, connections, batch_size=None, should_stop=None, rate_limiter=None):
         """
+        Sends the emails that are due over connections that are already open, so that long running senders can
+        reuse them across runs.
+
+        When the send_metrics signal has receivers, the time spent in each stage of the run and counts of the
+        emails that were handled are collected and sent with the signal once the run is done.
+
+        :param should_stop: An optional function that is called after each batch. No more batches are claimed
+            once it returns True.
+        :param rate_limiter: An optional RateLimiter to share across runs. Defaults to one that is created from
+            the rate limit settings for this run. No more batches are claimed once its global limit is used up.
+        :return: The number of emails that were claimed to be sent
+        """
+        metrics = SendMetrics(enabled=send_metrics.has_listeners())
+        rate_limiter = rate_limiter or RateLimiter.from_settings()
+        start = time.perf_counter()
 
         # Get the emails that we need to send
         current_time = datetime.utcnow()
         email_medium = get_medium()
-        to_send = Email.objects.filter(
+        batch_size = batch_size or getattr(settings, 'ENTITY_EMAILER_SEND_BATCH_SIZE', 500)
+
+        # Keep track of the email address of each recipient across batches, up to a bounded number of recipients
+        entity_email_addresses = {}
+        max_email_addresses = getattr(settings, 'ENTITY_EMAILER_EMAIL_ADDRESS_CACHE_SIZE', 10000)
+
+        # Send the emails one batch at a time over the same connections. Each batch is released before the next
+        # one is claimed so that only one batch of emails, events and rendered messages is ever held in memory
+        num_emails = 0
+        for to_send in cls.get_unsent_email_batches(current_time, batch_size, metrics):
+            rate_limited = cls.send_email_batch(
+                to_send, email_medium, current_time, connections, entity_email_addresses, metrics, rate_limiter
+            )
+            num_emails += len(to_send)
+            del to_send
+            if len(entity_email_addresses) > max_email_addresses:
+                entity_email_addresses.clear()
+            if rate_limited or (should_stop is not None and should_stop()):
+                break
+
+        if metrics.enabled:
+            metrics.timings['total'] = time.perf_counter() - start
+            send_metrics.send(sender=cls, metrics=metrics)
+
+        return num_emails
+
+    @classmethod
+    async def asend_unsent_scheduled_emails(cls, batch_size=None, num_workers=None, use_async=None):
+        """
+        Awaitable version of send_unsent_scheduled_emails, which is run in a thread
+
+        :return: The number of emails that were claimed to be sent
+        """
+        return await sync_to_async(cls.send_unsent_scheduled_emails)(batch_size, num_workers, use_async)
+
+    @classmethod
+    def get_unsent_email_batches(cls, current_time, batch_size=None, metrics=None):
+        """
+        Yields lists of claimed emails that are due to be sent, ordered by their scheduled time and id. Batches are
+        paginated on the (scheduled, id) key of the last email of the previous batch, so emails that remain unsent
+        after a failure are not picked up again by the same run.
+        """
+        metrics = metrics or SendMetrics()
+        last_email = None
+        while True:
+            with metrics.timer('claim'):
+                batch = cls.claim_unsent_emails(current_time, batch_size, last_email)
+
+            # A short batch means that there are no more emails to send
+            if not batch_size or len(batch) < batch_size:
+                if batch:
+                    yield batch
+                return
+
+            # Keep the key of the last email as it was claimed, since sending the batch may reschedule it
+            last_email = Email(id=batch[-1].id, scheduled=batch[-1].scheduled)
+            yield batch
+            del batch
+
+    @staticmethod
+    def claim_unsent_emails(current_time, batch_size=None, last_email=None):
+        """
+        Claims a batch of the emails that are due to be sent so that concurrent senders work on disjoint emails.
+
+        The due rows are locked with SELECT ... FOR UPDATE SKIP LOCKED where the database supports it, so other
+        senders skip over them rather than waiting, and are then leased to this sender. The lease keeps the emails
+        claimed once the locking transaction has committed and releases them to other senders if this one dies
+        before finishing the batch.
+
+        The lease must outlast the rendering and delivery of the whole batch, so it lasts
+        ENTITY_EMAILER_CLAIM_LEASE_SECONDS_PER_EMAIL for each claimed email, and at least
+        ENTITY_EMAILER_CLAIM_LEASE_SECONDS. Larger batches or slower backends need a longer lease per email. If a
+        lease does expire before the batch is done, its emails may be claimed and sent again by another sender, and
+        save_email_outcomes leaves the emails that have been claimed again to that sender.
+
+        Emails are claimed in the order of their scheduled time, which is the time of the next attempt of emails
+        that have been rescheduled by the retry policy or the rate limits, and then their id.
+
+        :param batch_size: The maximum number of emails to claim, or None to claim every due email
+        :param last_email: Only claim emails ordered after this email
+        :return: A list of the claimed emails ordered by their scheduled time and id
+        """
+        claim_time = datetime.utcnow()
+        min_lease_seconds = getattr(settings, 'ENTITY_EMAILER_CLAIM_LEASE_SECONDS', 600)
+        lease_seconds_per_email = getattr(settings, 'ENTITY_EMAILER_CLAIM_LEASE_SECONDS_PER_EMAIL', 5)
+
+        to_claim = Email.objects.filter(
+            Q(claimed_until__isnull=True) | Q(claimed_until__lte=claim_time),
             scheduled__lte=current_time,
             sent__isnull=True,
             num_tries__lt=settings.ENTITY_EMAILER_MAX_SEND_MESSAGE_TRIES
+        ).order_by(
+            'scheduled',
+            'id'
+        )
+        if last_email is not None:
+            to_claim = to_claim.filter(
+                Q(scheduled__gt=last_email.scheduled) | Q(scheduled=last_email.scheduled, id__gt=last_email.id)
+            )
+
+        features = connections[Email.objects.db].features
+        with transaction.atomic():
+            # Skip rows locked by other senders when possible, otherwise wait for their claims to commit
+            if features.has_select_for_update_skip_locked:
+                to_claim = to_claim.select_for_update(skip_locked=True)
+            elif features.has_select_for_update:  # pragma: no cover
+                to_claim = to_claim.select_for_update()
+
+            to_claim = to_claim.values_list('id', flat=True)
+            if batch_size:
+                to_claim = to_claim[:batch_size]
+            claimed_ids = list(to_claim)
+
+            lease = timedelta(seconds=max(min_lease_seconds, len(claimed_ids) * lease_seconds_per_email))
+            Email.objects.filter(id__in=claimed_ids).update(claimed_until=claim_time + lease)
+
+        return list(Email.objects.filter(
+            id__in=claimed_ids
         ).select_related(
             'event__source'
-        ).prefetch_related(
-            'recipients'
         ).order_by(
             'scheduled',
             'id'
-        )
+        ))
+
+    @staticmethod
+    def load_event_contexts(to_send, email_medium):
+        """
+        Loads the contexts and renderers of the events of the emails. The emails of a batch often share events,
+        so each distinct event is only loaded once and shared by its emails, which render with their own ids
+        layered over the shared context.
+        """
+        events = {}
+        for email in to_send:
+            events.setdefault(email.event_id, email.event)
+        context_loader.load_contexts_and_renderers(list(events.values()), [email_medium])
+
+        for email in to_send:
+            email.event = events[email.event_id]
+
+    @classmethod
+    def send_email_batch(
+        cls, to_send, email_medium, current_time, connections, entity_email_addresses=None, metrics=None,
+        rate_limiter=None
+    ):
+        """
+        Renders and sends a batch of emails over the given backend connections
+
+        :param entity_email_addresses: An optional dict of the email addresses of recipients resolved by
+            previous batches
+        :param metrics: An optional SendMetrics that the timings and counts of the batch are added to
+        :param rate_limiter: An optional RateLimiter. Once its global limit is used up, the rest of the batch is
+            released unchanged for a later run to send. Emails that would exceed the limit of their recipient domains
+            are deferred by moving their scheduled time to a slot when they may be sent rather than being failed.
+        :return: True if the global rate limit was used up, in which case no more emails should be sent for now
+        """
+        metrics = metrics or SendMetrics()
+        rate_limiter = rate_limiter or RateLimiter()
+        metrics.incr('considered', len(to_send))
 
         # Fetch the contexts of every event so that they may be rendered
-        context_loader.load_contexts_and_renderers([e.event for e in to_send], [email_medium])
+        with metrics.timer('load_contexts'):
+            cls.load_event_contexts(to_send, email_medium)
+
+        # Resolve the email addresses of the recipients of every email
+        with metrics.timer('resolve_addresses'):
+            prefetch_subscribed_email_addresses(to_send, entity_email_addresses)
 
-        # Keep track of what emails we will be sending
+        # Keep track of what emails we will be sending, and of the outcomes to save once the batch is done
         emails_to_send = []
+        sent_emails = []
+        failed_emails = []
+        deferred_emails = []
+        released_emails = []
+
+        # Render the emails that share an event only once unless the render cache has been disabled
+        rendered_events = {} if getattr(settings, 'ENTITY_EMAILER_RENDER_CACHE', True) else None
+
+        # Encode each distinct html body once for all of the emails of the batch if the MIME cache is enabled
+        mime_parts = {} if getattr(settings, 'ENTITY_EMAILER_MIME_CACHE', False) else None
 
         # Loop over each email and generate the recipients, and message
         # and handle any exceptions that may occur
-        for email in to_send:
+        for i, email in enumerate(to_send):
+            # Stop once the global rate limit has been used up, leaving the rest of the emails to a later run rather
+            # than rescheduling every one of them
+            if rate_limiter.is_exhausted():
+                released_emails = to_send[i:]
+                metrics.incr('released', len(released_emails))
+                break
+
             # Compute what email addresses we actually want to send this email to
             to_email_addresses = get_subscribed_email_addresses(email)
 
             # If there are no recipients we can just skip rendering
             # and mark the email as sent
             if not to_email_addresses:
-                email.sent = current_time
-                email.save(update_fields=['sent'])
+                sent_emails.append(email)
+                metrics.incr('skipped')
+                continue
+
+            # Defer the email until it may be sent if sending it now would exceed the rate limits
+            delay = rate_limiter.acquire(to_email_addresses)
+            if delay:
+                deferred_emails.append((email, delay))
+                metrics.incr('deferred')
                 continue
 
             # If any exceptions occur we will catch the exception and store it as a reference
             # As well as fire off a signal with the error and mark the email as sent and errored
             try:
                 # Render the email
-                text_message, html_message = email.render(email_medium)
+                with metrics.timer('render'):
+                    text_message, html_message = email.render(email_medium, rendered_events)
+                metrics.incr('rendered')
+
+                with metrics.timer('extract_subject'):
+                    subject = email.subject or extract_email_subject_from_html_content(html_message)
 
                 # Create the email
                 message = create_email_message(
                     to_emails=to_email_addresses,
                     from_email=email.from_address or get_from_email_address(),
-                    subject=email.subject or extract_email_subject_from_html_content(html_message),
+                    subject=subject,
                     text=text_message,
                     html=html_message,
+                    mime_parts=mime_parts,
                 )
 
                 # Fire the pre send signal
@@ -82,7 +325,7 @@ class EntityEmailerInterface(object):
                     sender=sys.intern(email.event.source.name),
                     email=email,
                     event=email.event,
-                    context=email.event.context,
+                    context=dict(email.get_context()),
                     message=message,
                 )
 
@@ -92,21 +335,149 @@ class EntityEmailerInterface(object):
                     'model': email,
                 })
             except Exception:
-                # Save the exception on the model
-                cls.save_email_exception(email, traceback.format_exc())
+                # Keep the exception to save on the model
+                failed_emails.append((email, traceback.format_exc()))
+
+        messages_to_send = cls.get_messages_to_send(emails_to_send, connections)
 
         # Send all the emails that were generated properly
-        with mail.get_connection() as connection:
-            for email in emails_to_send:
+        with metrics.timer('deliver'):
+            exceptions = cls.deliver_messages([message.get('message') for message in messages_to_send], connections)
+
+        # Record the outcome of each email in the order that they were rendered
+        for message, exception in zip(messages_to_send, exceptions):
+            if exception is None:
+                sent_emails.extend(message.get('models'))
+                metrics.incr('sent', len(message.get('models')))
+                if metrics.enabled:
+                    metrics.incr('bytes_sent', get_content_size(message.get('message')))
+            else:
+                failed_emails.extend((email, exception) for email in message.get('models'))
+
+        metrics.incr('failed', len(failed_emails))
+
+        with metrics.timer('save_outcomes'):
+            cls.save_email_outcomes(sent_emails, failed_emails, current_time, deferred_emails, released_emails)
+
+        return bool(released_emails)
+
+    @classmethod
+    def get_messages_to_send(cls, emails_to_send, connections):
+        """
+        Returns a list of dicts of the messages to deliver and the emails that each one sends
+        """
+        # Merge the emails with identical content into batch messages only if every backend sends them as a
+        # batch of individual messages, since other backends would show each recipient all the others
+        if (
+            getattr(settings, 'ENTITY_EMAILER_MERGE_IDENTICAL_EMAILS', False) and
+            not isinstance(connections, AsyncConnectionPool) and
+            all(cls.supports_merge_data(connection) for connection in connections)
+        ):
+            return cls.merge_messages(emails_to_send)
+
+        return [
+            {'message': email.get('message'), 'models': [email.get('model')]}
+            for email in emails_to_send
+        ]
+
+    @staticmethod
+    def supports_merge_data(connection):
+        """
+        Returns whether the backend connection sends a message with merge_data as a batch of individual
+        messages. Backends declare it with a supports_merge_data attribute, and Anymail backends support it.
+        """
+        if hasattr(connection, 'supports_merge_data'):
+            return bool(connection.supports_merge_data)
+
+        return type(connection).__module__.split('.')[0] == 'anymail'
+
+    @staticmethod
+    def merge_messages(emails_to_send):
+        """
+        Merges the messages of emails with identical senders, subjects, content, headers and attachments into one
+        message per group of up to ENTITY_EMAILER_MERGE_MAX_RECIPIENTS recipients. The recipients of a merged
+        message are given merge_data, which backends such as Anymail send as a batch of individual messages, so
+        recipients never see each other. It is only used with backends that support merge_data.
+        Emails whose templates render their own entity_emailer_id are never identical and are not merged.
+
+        :param emails_to_send: A list of dicts of the message and model of each email
+        :return: A list of dicts of each message and the list of models of the emails that it sends
+        """
+        max_recipients = getattr(settings, 'ENTITY_EMAILER_MERGE_MAX_RECIPIENTS', 1000)
+
+        messages_to_send = []
+        groups = {}
+        for email in emails_to_send:
+            message = email.get('message')
+            key = (
+                message.from_email,
+                message.subject,
+                message.body,
+                tuple(getattr(message, 'alternatives', ())),
+                tuple(message.cc),
+                tuple(message.bcc),
+                tuple(message.reply_to),
+                tuple(sorted(message.extra_headers.items())),
+                tuple(message.attachments),
+            )
+            group = groups.get(key)
+            if group is None or len(group['message'].to) + len(message.to) > max_recipients:
+                # Start a new group with a copy of the message so that the message of the email is unchanged
+                group = groups[key] = {'message': copy.copy(message), 'models': []}
+                group['message'].to = []
+                messages_to_send.append(group)
+
+            group['message'].to.extend(message.to)
+            group['models'].append(email.get('model'))
+
+        for group in messages_to_send:
+            group['message'].merge_data = {address: {} for address in group['message'].to}
+
+        return messages_to_send
+
+    @staticmethod
+    def deliver_messages(messages, connections):
+        """
+        Sends the messages over the given backend connections. The messages are handed to each call of
+        send_messages in batches of ENTITY_EMAILER_SEND_MESSAGES_BATCH_SIZE, which defaults to 1. With more than
+        one connection the batches are drained from a shared queue by one thread per connection. The connections
+        may also be an AsyncConnectionPool, which sends the messages concurrently with asyncio.
+
+        Any exception raised while sending a batch is caught so that it does not affect the other batches. Since
+        backends do not report which messages of a batch were sent before an exception, it is recorded for every
+        message of the batch.
+
+        :return: A list with the exception raised for each message, or None if the message was sent
+        """
+        if isinstance(connections, AsyncConnectionPool):
+            return connections.deliver_messages(messages)
+
+        batch_size = getattr(settings, 'ENTITY_EMAILER_SEND_MESSAGES_BATCH_SIZE', 1)
+        exceptions = [None] * len(messages)
+        to_deliver = SimpleQueue()
+        for i in range(0, len(messages), batch_size):
+            to_deliver.put((i, messages[i:i + batch_size]))
+
+        def deliver(connection):
+            while True:
                 try:
-                    # Send mail
-                    connection.send_messages([email.get('message')])
-                    # Update the email model sent value
-                    email_model = email.get('model')
-                    email_model.sent = current_time
-                    email_model.save(update_fields=['sent'])
+                    i, batch = to_deliver.get_nowait()
+                except Empty:
+                    return
+
+                try:
+                    connection.send_messages(batch)
                 except Exception as e:
-                    cls.save_email_exception(email.get('model'), e)
+                    exceptions[i:i + len(batch)] = [e] * len(batch)
+
+        if len(connections) == 1:
+            deliver(connections[0])
+        else:
+            with ThreadPoolExecutor(max_workers=len(connections)) as executor:
+                # Consume the results so that any unexpected error in a worker is raised
+                list(executor.map(deliver, connections))
+
+        return exceptions
 
     @staticmethod
     def convert_events_to_emails():
@@ -129,12 +500,18 @@ class EntityEmailerInterface(object):
             # Create the emails
             Email.objects.create_email(event=event, from_address=from_address, recipients=targets)
 
-    @staticmethod
-    @transaction.atomic
-    def bulk_convert_events_to_emails():
+    @classmethod
+    def bulk_convert_events_to_emails(cls, batch_size=None):
         """
         Converts unseen events to emails and marks them as seen. Uses the create_emails method to bulk create
         emails and recipient relationships
+
+        The unseen events are converted in batches ordered by their time. The emails of each batch are created
+        and its events are marked as seen in the same transaction, so a failure part way through neither loses
+        the events of the batches that were not committed nor duplicates the emails of those that were.
+
+        :param batch_size: The maximum number of events to convert at a time. Falls back to the
+            ENTITY_EMAILER_CONVERT_BATCH_SIZE setting and defaults to 1000.
         """
 
         # Get the email medium
@@ -143,10 +520,53 @@ class EntityEmailerInterface(object):
         # Get the default from email
         default_from_email = get_from_email_address()
 
-        email_params_list = []
+        batch_size = batch_size or getattr(settings, 'ENTITY_EMAILER_CONVERT_BATCH_SIZE', 1000)
 
-        # Find any unseen events and create unsent email objects
-        for event, targets in email_medium.events_targets(seen=False, mark_seen=True):
+        # Resolve who is subscribed to the medium once for all of the batches
+        subscriptions = cls.get_subscriptions(email_medium)
+
+        # Convert batches until there are no unseen events left
+        while cls.bulk_convert_event_batch(email_medium, default_from_email, batch_size, subscriptions):
+            pass
+
+    @classmethod
+    @transaction.atomic
+    def bulk_convert_event_batch(cls, email_medium, default_from_email, batch_size, subscriptions=None):
+        """
+        Converts the oldest batch of unseen events to emails and marks them as seen.
+
+        :param subscriptions: The subscriptions of the medium from get_subscriptions, which are fetched if they
+            are not given
+        :return: True if there were any unseen events to convert
+        """
+        subscriptions = subscriptions or cls.get_subscriptions(email_medium)
+
+        # Find the oldest unseen events
+        unseen_events = email_medium.get_filtered_events_queryset(
+            start_time=None,
+            end_time=None,
+            seen=False,
+            include_expired=False,
+            actor=None,
+        ).order_by(
+            'time',
+            'id'
+        ).values_list(
+            'id',
+            'time'
+        )
+        batch = list(unseen_events[:batch_size])
+        if not batch:
+            return False
+
+        event_ids = [event_id for event_id, time in batch]
+
+        # Find the targets of only the events of the batch
+        email_params_list = []
+        for event in Event.objects.filter(id__in=event_ids).order_by('time', 'id'):
+            recipient_ids = cls.get_event_target_ids(email_medium, event, subscriptions)
+            if not recipient_ids:
+                continue
 
             # Check the event's context for a from_address, otherwise fallback to default
             from_address = event.context.get('from_address') or default_from_email
@@ -154,15 +574,152 @@ class EntityEmailerInterface(object):
             email_params_list.append(dict(
                 event=event,
                 from_address=from_address,
-                recipients=targets
+                recipient_ids=recipient_ids
             ))
 
         # Bulk create the emails
-        Email.objects.create_emails(email_params_list)
+        Email.objects.create_emails(email_params_list, batch_size=batch_size)
+
+        # Mark every event of the batch as seen, including those without any targets
+        Event.objects.filter(id__in=event_ids).mark_seen(email_medium)
+
+        return True
+
+    @staticmethod
+    def get_subscriptions(email_medium):
+        """
+        Fetches the subscriptions of the medium with the ids of the entities that each one subscribes, and the ids
+        of the entities that are unsubscribed from each source, so that the targets of events may be found without
+        querying them again for every event.
+
+        :return: A tuple of a dict of source id to a list of (subscription, subscribed entity ids) tuples, and a dict
+            of source id to the set of unsubscribed entity ids
+        """
+        subscriptions = defaultdict(list)
+        for subscription in Subscription.objects.filter(medium=email_medium).select_related('entity'):
+            subscriptions[subscription.source_id].append(
+                (subscription, set(subscription.subscribed_entities().values_list('id', flat=True)))
+            )
+
+        unsubscriptions = defaultdict(set)
+        for entity_id, source_id in Unsubscription.objects.filter(
+            medium=email_medium
+        ).values_list(
+            'entity_id',
+            'source_id'
+        ):
+            unsubscriptions[source_id].add(entity_id)
+
+        return subscriptions, unsubscriptions
+
+    @staticmethod
+    def get_event_target_ids(email_medium, event, subscriptions):
+        """
+        Returns the ids of the entities that the event targets in the same way as Medium.events_targets, from
+        subscriptions that were fetched with get_subscriptions
+        """
+        subscriptions, unsubscriptions = subscriptions
+        target_ids = []
+        for subscription, subscribed_ids in subscriptions[event.source_id]:
+            if subscription.only_following:
+                followers = email_medium.followers_of(event.eventactor_set.values_list('entity__id', flat=True))
+                target_ids.extend(
+                    entity_id
+                    for entity_id in followers.values_list('id', flat=True)
+                    if entity_id in subscribed_ids
+                )
+            else:
+                target_ids.extend(subscribed_ids)
+
+        return [entity_id for entity_id in target_ids if entity_id not in unsubscriptions[event.source_id]]
+
+    @classmethod
+    def save_email_outcomes(cls, sent_emails, failed_emails, current_time, deferred_emails=None, released_emails=None):
+        """
+        Saves the outcomes of a batch of emails with one update for the sent emails and one bulk update for
+        the failed emails, and then fires the exception signal for each failed email.
+
+        :param sent_emails: A list of the emails that were sent
+        :param failed_emails: A list of (email, exception) tuples for the emails that failed
+        :param current_time: The time to mark the sent emails as sent at
+        :param deferred_emails: An optional list of (email, delay) tuples for the emails that were held back by
+            the rate limits. They are rescheduled the number of seconds of their delay from now and released
+            without counting an attempt.
+        :param released_emails: An optional list of the emails that were not attempted, which are released
+            unchanged for a later run to send
+
+        Outcomes are only saved for the emails that are still claimed with the claimed_until time that they were
+        loaded with. Once the lease of an email has expired, another sender may have claimed it again, and the
+        outcome of that sender is not overwritten.
+        """
+        for claim, emails in cls.group_by_claim(released_emails or []):
+            claim.filter(id__in=[email.id for email in emails]).update(claimed_until=None)
+
+        deferred_emails = deferred_emails or []
+        claims = cls.group_by_claim([email for email, delay in deferred_emails])
+        now = datetime.utcnow()
+        for email, delay in deferred_emails:
+            email.scheduled = now + timedelta(seconds=delay)
+            email.claimed_until = None
+        for claim, emails in claims:
+            claim.bulk_update(emails, ['scheduled', 'claimed_until'])
+
+        for claim, emails in cls.group_by_claim(sent_emails):
+            claim.filter(id__in=[email.id for email in emails]).update(sent=current_time)
+        for email in sent_emails:
+            email.sent = current_time
+
+        if failed_emails:
+            claims = cls.group_by_claim([email for email, e in failed_emails])
+            for email, e in failed_emails:
+                cls.set_email_exception(email, e)
+            for claim, emails in claims:
+                claim.bulk_update(emails, ['exception', 'num_tries', 'claimed_until', 'scheduled'])
+
+            # Fire the email exception events
+            for email, e in failed_emails:
+                email_exception.send(
+                    sender=Email,
+                    email=email,
+                    exception=e
+                )
+
+    @staticmethod
+    def group_by_claim(emails):
+        """
+        Groups the emails by the claimed_until time that they were loaded with, which is the same for every email
+        of a claimed batch
+
+        :return: A list of (queryset, emails) tuples, where the queryset only matches the emails of the claim
+        """
+        claims = defaultdict(list)
+        for email in emails:
+            claims[email.claimed_until].append(email)
+
+        return [
+            (Email.objects.filter(claimed_until=claimed_until), claimed_emails)
+            for claimed_until, claimed_emails in claims.items()
+        ]
 
     @classmethod
     def save_email_exception(cls, email, e):
         # Save the error to the email model
+        cls.set_email_exception(email, e)
+        email.save(update_fields=['exception', 'num_tries', 'claimed_until', 'scheduled'])
+
+        # Fire the email exception event
+        email_exception.send(
+            sender=Email,
+            email=email,
+            exception=e
+        )
+
+    @staticmethod
+    def set_email_exception(email, e):
+        """
+        Stores the exception on the email, counts the failed attempt and reschedules the email according to the
+        retry policy of get_retry_delay without saving the email
+        """
         exception_message = str(e)
 
         # Duck typing exception for sendgrid api backend rather than place hard dependency
@@ -178,11 +735,8 @@ class EntityEmailerInterface(object):
 
         email.exception = exception_message
         email.num_tries += 1
-        email.save(update_fields=['exception', 'num_tries'])
-
-        # Fire the email exception event
-        email_exception.send(
-            sender=Email,
-            email=email,
-            exception=e
-        )
+        # Release the claim on the email so that it may be retried, and back off from retrying it right away
+        email.claimed_until = None
+        retry_delay = get_retry_delay(email.num_tries)
+        if retry_delay:
+            email.scheduled = datetime.utcnow() + timedelta(seconds=retry_delay)
@@ -0,0 +1,179 @@
+from contextlib import ExitStack
+import select
+import signal
+import smtplib
+import threading
+import time
+import traceback
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, connections
+
+from entity_emailer.async_delivery import AsyncConnectionPool
+from entity_emailer.interface import EntityEmailerInterface
+from entity_emailer.rate_limit import RateLimiter
+
+
+# The channel that the email notify trigger notifies when emails are inserted
+NOTIFY_CHANNEL = 'entity_emailer_email'
+
+
+class Command(BaseCommand):
+    """
+    Sends scheduled emails as they become due from a long running process, which keeps its connections to the
+    email server and its caches warm between polls.
+
+    The time between polls is doubled from the minimum interval up to the maximum interval for as long as
+    there are no due emails, and is reset to the minimum interval once there are. With --listen the sender is
+    also woken up as soon as new emails are inserted into a PostgreSQL database.
+
+    SIGTERM and SIGINT stop the sender once the batch that is being sent has been saved.
+    """
+    help = 'Sends scheduled emails as they become due, polling for them with an adaptive interval'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='The number of emails to send at a time')
+        parser.add_argument('--workers', type=int, default=None, help='The number of connections to send over')
+        parser.add_argument(
+            '--async', dest='use_async', action='store_true', default=None,
+            help='Send over a pool of asyncio SMTP connections',
+        )
+        parser.add_argument(
+            '--min-interval', type=float, default=1, help='The minimum number of seconds between polls',
+        )
+        parser.add_argument(
+            '--max-interval', type=float, default=60, help='The maximum number of seconds between polls',
+        )
+        parser.add_argument(
+            '--listen', action='store_true', default=False,
+            help='Wake up when new emails are inserted with PostgreSQL LISTEN/NOTIFY',
+        )
+        parser.add_argument(
+            '--max-polls', type=int, default=None, help='Stop after polling this many times',
+        )
+
+    def handle(self, *args, **options):
+        if options['listen'] and connection.vendor != 'postgresql':
+            raise CommandError('--listen requires a PostgreSQL database')
+
+        self.stopping = threading.Event()
+        # Share the rate limits across polls
+        self.rate_limiter = RateLimiter.from_settings()
+        previous_handlers = {
+            signum: signal.signal(signum, self.stop)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+
+        try:
+            with ExitStack() as stack:
+                email_connections = EntityEmailerInterface.open_connections(
+                    stack, options['workers'], options['use_async']
+                )
+                self.poll(email_connections, options)
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+    def stop(self, signum, frame):
+        self.stopping.set()
+
+    def poll(self, email_connections, options):
+        """
+        Sends the due emails until the sender is stopped, waiting longer between polls that find nothing to send
+        """
+        interval = options['min_interval']
+        num_polls = 0
+        while not self.stopping.is_set():
+            num_emails = self.send_due_emails(email_connections, options['batch_size'])
+
+            num_polls += 1
+            if options['max_polls'] and num_polls >= options['max_polls']:
+                return
+
+            if num_emails:
+                interval = options['min_interval']
+            else:
+                interval = min(interval * 2, options['max_interval'])
+
+            self.wait(interval, options['listen'])
+
+    def send_due_emails(self, email_connections, batch_size):
+        """
+        Sends the due emails, reporting rather than raising any error so that the sender keeps running
+        """
+        try:
+            self.refresh_connections(email_connections)
+            return EntityEmailerInterface.send_due_emails(
+                email_connections, batch_size, should_stop=self.stopping.is_set, rate_limiter=self.rate_limiter
+            )
+        except Exception:
+            self.stderr.write(traceback.format_exc())
+            # Drop any broken database connections so that they are reopened by the next poll
+            for database_connection in connections.all():
+                if database_connection.connection is not None and not database_connection.is_usable():
+                    database_connection.close()
+            return 0
+
+    def refresh_connections(self, email_connections):
+        """
+        Reopens the SMTP connections that the server has closed while the sender was idle. An asyncio connection
+        pool already reconnects its connections as they are found to be closed.
+        """
+        if isinstance(email_connections, AsyncConnectionPool):
+            return
+
+        for email_connection in email_connections:
+            smtp_connection = getattr(email_connection, 'connection', None)
+            if smtp_connection is None:
+                continue
+
+            try:
+                if smtp_connection.noop()[0] == 250:
+                    continue
+            except (smtplib.SMTPException, OSError):
+                pass
+
+            email_connection.close()
+            email_connection.open()
+
+    def wait(self, interval, listen):
+        """
+        Waits for the interval to pass, for the sender to be stopped or when listening, for emails to be inserted
+        """
+        deadline = time.monotonic() + interval
+        if listen:
+            self.listen()
+
+        while not self.stopping.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+
+            if not listen:
+                self.stopping.wait(remaining)
+            elif self.wait_for_notification(min(remaining, 1)):
+                return
+
+    def listen(self):
+        """
+        Listens for notifications of inserted emails on the database connection. This is repeated before each wait
+        since the connection may have been reopened.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('LISTEN {0}'.format(NOTIFY_CHANNEL))
+
+    def wait_for_notification(self, timeout):
+        """
+        Waits up to the timeout for notifications of inserted emails
+
+        :return: True if emails were inserted
+        """
+        raw_connection = connection.connection
+        if not raw_connection.notifies:
+            select.select([raw_connection], [], [], timeout)
+            raw_connection.poll()
+
+        if raw_connection.notifies:
+            raw_connection.notifies.clear()
+            return True
+        return False
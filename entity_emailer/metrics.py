@@ -0,0 +1,49 @@
+from collections import defaultdict
+from contextlib import nullcontext
+import time
+
+
+class StageTimer(object):
+    """
+    Adds the time spent in a block to the total time of a stage.
+    """
+    def __init__(self, timings, stage):
+        self.timings = timings
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.timings[self.stage] += time.perf_counter() - self.start
+
+
+class SendMetrics(object):
+    """
+    Collects the total time spent in each stage of sending emails along with counts of the emails that
+    were handled. When it is not enabled nothing is timed or counted.
+    """
+    null_timer = nullcontext()
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.timings = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    def timer(self, stage):
+        """
+        Returns a context manager that adds the time spent in its block to the given stage.
+        """
+        if not self.enabled:
+            return self.null_timer
+        return StageTimer(self.timings, stage)
+
+    def incr(self, name, value=1):
+        if self.enabled:
+            self.counts[name] += value
+
+    def as_dict(self):
+        return {
+            'timings': dict(self.timings),
+            'counts': dict(self.counts),
+        }
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 18:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entity_emailer', '0001_0004_squashed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='claimed_until',
+            field=models.DateTimeField(default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.30 on 2026-10-18 18:59
+
+from django.db import migrations, models
+
+
+class AddIndexConcurrently(migrations.AddIndex):
+    """
+    Adds the index concurrently on PostgreSQL so that emails may still be written while it is built, and adds it
+    as usual on other databases
+    """
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.add_index(model, self.index, concurrently=True)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.remove_index(model, self.index, concurrently=True)
+
+
+class Migration(migrations.Migration):
+    # PostgreSQL cannot build an index concurrently inside of a transaction
+    atomic = False
+
+    dependencies = [
+        ('entity_emailer', '0002_email_claimed_until'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='email',
+            index=models.Index(condition=models.Q(('sent__isnull', True)), fields=['scheduled', 'id'], name='entity_emailer_email_due'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:00
+
+from django.db import migrations, models
+import uuid
+
+
+class AlterFieldUniqueConcurrently(migrations.AlterField):
+    """
+    Makes the field unique on PostgreSQL by building its unique index concurrently, so that emails may still be
+    written while it is built, and then attaching the index to the constraint that Django would have created for
+    the unique field. Other databases alter the field as usual.
+    """
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+        schema_editor.execute(
+            'CREATE UNIQUE INDEX CONCURRENTLY entity_emailer_email_view_uid_548373f7_uniq '
+            'ON entity_emailer_email (view_uid)'
+        )
+        schema_editor.execute(
+            'ALTER TABLE entity_emailer_email ADD CONSTRAINT entity_emailer_email_view_uid_548373f7_uniq '
+            'UNIQUE USING INDEX entity_emailer_email_view_uid_548373f7_uniq'
+        )
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+        schema_editor.execute(
+            'ALTER TABLE entity_emailer_email DROP CONSTRAINT entity_emailer_email_view_uid_548373f7_uniq'
+        )
+
+
+class Migration(migrations.Migration):
+    # PostgreSQL cannot build an index concurrently inside of a transaction
+    atomic = False
+
+    dependencies = [
+        ('entity_emailer', '0003_email_due_index'),
+    ]
+
+    operations = [
+        AlterFieldUniqueConcurrently(
+            model_name='email',
+            name='view_uid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+    ]
@@ -0,0 +1,47 @@
+from django.db import migrations
+
+
+def create_notify_trigger(apps, schema_editor):
+    """
+    Notifies the entity_emailer_email channel whenever emails are inserted, so that senders which are
+    listening for them may wake up rather than wait for their next poll
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    schema_editor.execute(
+        """
+        CREATE OR REPLACE FUNCTION entity_emailer_email_notify() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('entity_emailer_email', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    schema_editor.execute(
+        """
+        CREATE TRIGGER entity_emailer_email_notify
+        AFTER INSERT ON entity_emailer_email
+        FOR EACH STATEMENT EXECUTE PROCEDURE entity_emailer_email_notify()
+        """
+    )
+
+
+def drop_notify_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    schema_editor.execute('DROP TRIGGER IF EXISTS entity_emailer_email_notify ON entity_emailer_email')
+    schema_editor.execute('DROP FUNCTION IF EXISTS entity_emailer_email_notify()')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entity_emailer', '0004_email_view_uid_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_notify_trigger, drop_notify_trigger),
+    ]
@@ -1,71 +1,123 @@
+from array import array
+from collections import ChainMap
+import copy
 from datetime import datetime
+from itertools import islice
 
 from django.db import models, transaction
+from django.db.models.signals import m2m_changed
 from entity.models import Entity
 from entity_event.models import Event
 import uuid
 
 
+class ContextOverlay(ChainMap, dict):
+    """
+    Layers a dict of overrides over a shared context without copying or modifying it. Writes only ever go to
+    the overrides, and copies only copy the overrides, so one loaded context may be rendered with different
+    overrides at the same time.
+
+    The overlay is a dict so that it is accepted by template engines, although its own dict storage is always
+    empty and every access goes through the ChainMap methods. Code that reads dict storage directly, such as
+    json.dumps, sees an empty dict, so the overlay should be converted with dict() before it is serialized.
+    """
+    def __reduce__(self):
+        # Pickle the maps rather than the empty dict storage
+        return (self.__class__, tuple(self.maps))
+
+
 class EmailManager(models.Manager):
     """
     Provides the ability to easily create emails with the recipients.
     """
-    def create_email(self, recipients=None, **kwargs):
+    @transaction.atomic
+    def create_email(self, recipients=None, recipient_ids=None, **kwargs):
         """
-        Note that we pop the scheduled time from the kwargs before creating the email
-        and then update the scheduled time after the recipients have been added. This
-        avoids the potential race condition of the email being created before it is
-        picked up by a task that sends it.
+        Note that the email and its recipients are inserted in a single transaction. This
+        avoids the potential race condition of the email being picked up by a task that
+        sends it before its recipients have been added, without having to update the
+        scheduled time after the recipients have been added.
+
+        The recipients are inserted directly into the through table, so the m2m_changed signal is sent here
+        as it would be by email.recipients.add.
         """
         scheduled = kwargs.pop('scheduled', datetime.utcnow())
-        email = Email.objects.create(scheduled=None, **kwargs)
-        if recipients:
-            email.recipients.add(*recipients)
+        email = Email.objects.create(scheduled=scheduled, **kwargs)
+
+        recipient_ids = set(recipient_ids or [])
+        # Recipients may be given as entities or as their primary keys, as they may be with email.recipients.add
+        recipient_ids.update(getattr(recipient, 'pk', recipient) for recipient in recipients or [])
+        if recipient_ids:
+            self.send_recipients_changed(email, 'pre_add', recipient_ids)
+            self.create_email_recipients((email.id, entity_id) for entity_id in sorted(recipient_ids))
+            self.send_recipients_changed(email, 'post_add', recipient_ids)
 
-        email.scheduled = scheduled
-        email.save()
         return email
 
+    def send_recipients_changed(self, email, action, recipient_ids):
+        m2m_changed.send(
+            sender=Email.recipients.through,
+            instance=email,
+            action=action,
+            reverse=False,
+            model=Entity,
+            pk_set=set(recipient_ids),
+            using=self.db,
+        )
+
     @transaction.atomic
-    def create_emails(self, email_params_list):
+    def create_emails(self, email_params_list, batch_size=None):
         """
-        :param email_params_list: A list of dicts containing the keys for the create_email method
+        :param email_params_list: A list of dicts containing the keys for the create_email method. The recipients
+            of each email may be given as entities with the recipients key or as entity ids with the recipient_ids
+            key.
+        :param batch_size: The maximum number of rows to insert with each query
         :return: list of Email objects that were created
         """
         emails_to_create = []
-        recipient_entities_per_email = []
+        recipient_ids_per_email = []
 
-        # Build the emails to create and keep track of recipients
+        # Build the emails to create and keep track of the unique recipient ids of each email in a compact array
         for kwargs in email_params_list:
             scheduled = kwargs.pop('scheduled', datetime.utcnow())
-            recipients = kwargs.pop('recipients', [])
+            recipient_ids = set(kwargs.pop('recipient_ids', []))
+            recipient_ids.update(recipient.id for recipient in kwargs.pop('recipients', []))
             emails_to_create.append(Email(scheduled=scheduled, **kwargs))
-            recipient_entities_per_email.append(recipients)
+            recipient_ids_per_email.append(array('q', sorted(recipient_ids)))
 
         # Bulk create the emails
-        emails = Email.objects.bulk_create(emails_to_create)
-
-        # Build list of recipient through relationships to create
-        recipients_to_create = []
+        emails = Email.objects.bulk_create(emails_to_create, batch_size=batch_size)
+
+        # Bulk create the recipient relationships a batch at a time, ignoring any that already exist
+        self.create_email_recipients(
+            (
+                (email.id, entity_id)
+                for email, recipient_ids in zip(emails, recipient_ids_per_email)
+                for entity_id in recipient_ids
+            ),
+            batch_size=batch_size,
+        )
 
-        # Keep track of unique pairs to avoid unique constraint on through relationship
-        email_entity_pairs = set()
-        for i, recipient_entities in enumerate(recipient_entities_per_email):
-            for recipient_entity in recipient_entities:
-                if (emails[i].id, recipient_entity.id) not in email_entity_pairs:
-                    email_entity_pairs.add((emails[i].id, recipient_entity.id))
+        return emails
 
-                    recipients_to_create.append(
-                        Email.recipients.through(
-                            email_id=emails[i].id,
-                            entity_id=recipient_entity.id,
-                        )
-                    )
+    def create_email_recipients(self, email_entity_ids, batch_size=None):
+        """
+        Inserts the recipient relationships of emails, ignoring any that already exist.
 
-        # Bulk create the recipient relationships
-        Email.recipients.through.objects.bulk_create(recipients_to_create)
+        :param email_entity_ids: An iterable of (email id, entity id) tuples
+        :param batch_size: The maximum number of relationships to build and insert at a time. Defaults to 1000.
+        """
+        email_entity_ids = iter(email_entity_ids)
+        batch_size = batch_size or 1000
+        while True:
+            recipients_to_create = [
+                Email.recipients.through(email_id=email_id, entity_id=entity_id)
+                for email_id, entity_id in islice(email_entity_ids, batch_size)
+            ]
+            if not recipients_to_create:
+                return
 
-        return emails
+            Email.recipients.through.objects.bulk_create(recipients_to_create, ignore_conflicts=True)
 
 
 class Email(models.Model):
@@ -90,7 +142,7 @@ class Email(models.Model):
 
     Emails are viewable online and identified with their view_uid UUID
     """
-    view_uid = models.UUIDField(default=uuid.uuid4, editable=False)
+    view_uid = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     event = models.ForeignKey(Event, on_delete=models.CASCADE)
     recipients = models.ManyToManyField(Entity)
     subject = models.CharField(max_length=256)
@@ -111,11 +163,71 @@ class Email(models.Model):
     # Any exception that occurred when attempting to send the email last
     exception = models.TextField(default=None, null=True)
 
+    # The time until which a sending worker holds its claim on this email. Other workers skip the email
+    # until the claim is released or has expired
+    claimed_until = models.DateTimeField(default=None, null=True)
+
     objects = EmailManager()
 
-    def render(self, medium):
+    class Meta:
+        indexes = [
+            # Serves the query for the emails that are due to be sent, which filters on unsent emails that are
+            # scheduled before the current time and orders them by their scheduled time and id
+            models.Index(
+                fields=['scheduled', 'id'],
+                condition=models.Q(sent__isnull=True),
+                name='entity_emailer_email_due',
+            ),
+        ]
+
+    def get_context(self, entity_emailer_id=None):
+        """
+        Returns the context of the event with the id of this email layered over it, leaving the context of the
+        event untouched so that it may be shared by the emails of the event.
+        """
+        return ContextOverlay({'entity_emailer_id': entity_emailer_id or str(self.view_uid)}, self.event.context)
+
+    def render(self, medium, rendered_events=None):
+        """
+        Renders the event, assuming it has already had its context and renderers prefetched. The context of the
+        event is not modified, so the emails of an event may be rendered concurrently from the same loaded event.
+
+        :param rendered_events: An optional dict that is used to render an event only twice per medium for all of
+            the emails of the event. The first email of the event is rendered with its own id. The second is rendered
+            too, and if its rendering only differs from the first by the id, the first rendering is shared by the rest
+            of the emails of the event with their own ids substituted into it. Otherwise, such as when a template
+            transforms the id, every email of the event is rendered on its own.
+        """
+        entity_emailer_id = str(self.view_uid)
+        if rendered_events is None:
+            return self.render_event(medium, entity_emailer_id)
+
+        key = (self.event_id, medium.id)
+        shared = rendered_events.get(key)
+        if shared is not None and shared['verified']:
+            return tuple(
+                content.replace(shared['entity_emailer_id'], entity_emailer_id) for content in shared['rendered']
+            )
+
+        rendered = self.render_event(medium, entity_emailer_id)
+        if key not in rendered_events:
+            rendered_events[key] = {'entity_emailer_id': entity_emailer_id, 'rendered': rendered, 'verified': False}
+        elif shared is not None:
+            substituted = tuple(
+                content.replace(shared['entity_emailer_id'], entity_emailer_id) for content in shared['rendered']
+            )
+            if substituted == tuple(rendered):
+                shared['verified'] = True
+            else:
+                rendered_events[key] = None
+
+        return rendered
+
+    def render_event(self, medium, entity_emailer_id):
         """
-        Renders the event, assuming it has already had its context and renderers prefetched.
+        Renders the event with the given email id. The event is rendered from a shallow copy whose context is
+        layered over the loaded context, which shares the loaded objects and renderers of the event.
         """
-        self.event.context['entity_emailer_id'] = str(self.view_uid)
-        return self.event.render(medium)
+        event = copy.copy(self.event)
+        event.context = self.get_context(entity_emailer_id)
+        return event.render(medium)
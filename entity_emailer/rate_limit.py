@@ -0,0 +1,110 @@
+from collections import Counter
+from email.utils import parseaddr
+import time
+
+from django.conf import settings
+
+
+class TokenBucket(object):
+    """
+    Allows an average of rate tokens to be taken per second with bursts of up to capacity tokens
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        # The time after which the next deferred message may be scheduled
+        self.next_slot = self.updated
+
+    def get_delay(self, tokens, now):
+        """
+        Returns the number of seconds until the tokens may be taken. No more than the capacity of the bucket is
+        ever waited for, so that a request larger than the capacity is let through once the bucket is full.
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0, (min(tokens, self.capacity) - self.tokens) / self.rate)
+
+    def take(self, tokens):
+        self.tokens -= tokens
+
+    def reserve_slot(self, tokens, delay, now):
+        """
+        Returns the number of seconds to defer a message by, which is at least the delay. Successive deferred
+        messages are spread out at the rate of the bucket so that they do not all become due at the same time.
+        """
+        slot = max(self.next_slot, now + delay)
+        self.next_slot = slot + tokens / self.rate
+        return slot - now
+
+
+class RateLimiter(object):
+    """
+    Limits the rate of sending messages with a global bucket of messages per second and a bucket of recipients
+    per second for each recipient domain.
+
+    :param rate: The maximum number of messages to send per second, or None for no global limit
+    :param domain_rates: A dict of recipient domain to the maximum number of recipients of the domain to send
+        to per second
+    :param default_domain_rate: The maximum number of recipients to send to per second for each domain that is
+        not in domain_rates, or None for no limit
+    """
+    def __init__(self, rate=None, domain_rates=None, default_domain_rate=None):
+        self.rate = rate
+        self.domain_rates = {domain.lower(): rate for domain, rate in (domain_rates or {}).items()}
+        self.default_domain_rate = default_domain_rate
+        self.enabled = bool(rate or self.domain_rates or default_domain_rate)
+
+        self.bucket = TokenBucket(rate) if rate else None
+        self.domain_buckets = {}
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Creates a rate limiter from the ENTITY_EMAILER_RATE_LIMIT, ENTITY_EMAILER_DOMAIN_RATE_LIMITS and
+        ENTITY_EMAILER_DEFAULT_DOMAIN_RATE_LIMIT settings, none of which are set by default
+        """
+        return cls(
+            rate=getattr(settings, 'ENTITY_EMAILER_RATE_LIMIT', None),
+            domain_rates=getattr(settings, 'ENTITY_EMAILER_DOMAIN_RATE_LIMITS', None),
+            default_domain_rate=getattr(settings, 'ENTITY_EMAILER_DEFAULT_DOMAIN_RATE_LIMIT', None),
+        )
+
+    def get_domain_bucket(self, domain):
+        if domain not in self.domain_buckets:
+            rate = self.domain_rates.get(domain, self.default_domain_rate)
+            self.domain_buckets[domain] = TokenBucket(rate) if rate else None
+        return self.domain_buckets[domain]
+
+    def is_exhausted(self):
+        """
+        Returns True if the global limit does not allow another message to be sent now
+        """
+        return self.bucket is not None and bool(self.bucket.get_delay(1, time.monotonic()))
+
+    def acquire(self, email_addresses):
+        """
+        Takes the tokens for sending a message to the email addresses if they are all available.
+
+        :return: 0 if the message may be sent now, otherwise the number of seconds to defer it by. The messages
+            that are deferred by a bucket are given slots that are spread out at its rate.
+        """
+        if not self.enabled:
+            return 0
+
+        domains = Counter(parseaddr(address)[1].rpartition('@')[2].lower() for address in email_addresses)
+        buckets = [(self.bucket, 1)] + [
+            (self.get_domain_bucket(domain), num_recipients)
+            for domain, num_recipients in domains.items()
+        ]
+        buckets = [(bucket, tokens) for bucket, tokens in buckets if bucket is not None]
+
+        now = time.monotonic()
+        delays = [(bucket, tokens, bucket.get_delay(tokens, now)) for bucket, tokens in buckets]
+        if any(delay for bucket, tokens, delay in delays):
+            return max(bucket.reserve_slot(tokens, delay, now) for bucket, tokens, delay in delays if delay)
+
+        for bucket, tokens in buckets:
+            bucket.take(tokens)
+        return 0
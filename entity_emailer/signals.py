@@ -8,3 +8,8 @@ pre_send = Signal()
 # An event that will be fired if an exception occurs when trying to send an email
 email_exception = Signal()
 """providing_args=['email', 'exception']"""
+
+# An event that will be fired with the timings and counts of each run of sending the unsent scheduled emails.
+# It is only collected when the signal has receivers
+send_metrics = Signal()
+"""providing_args=['metrics']"""
@@ -1,26 +1,32 @@
 from datetime import datetime
+import gc
+from html.parser import HTMLParser
 import json
+import threading
+import weakref
 
 from django.conf import settings
 from django.core import mail
 from django.core.mail import EmailMultiAlternatives
 from django.core.management import call_command
-from django.db import utils
-from django.test import TestCase, SimpleTestCase
-from django.test.utils import override_settings
+from django.db import connection, connections, transaction, utils
+from django.test import TestCase, SimpleTestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django_dynamic_fixture import G
 from entity.models import Entity, EntityRelationship, EntityKind
+from entity_event import context_loader
 from entity_event.models import (
-    Medium, Source, Subscription, Unsubscription, Event, EventActor
+    ContextRenderer, Medium, RenderingStyle, Source, Subscription, Unsubscription, Event, EventActor
 )
 from freezegun import freeze_time
 from unittest.mock import patch
 
 from entity_emailer.interface import EntityEmailerInterface
 from entity_emailer.models import Email
+from entity_emailer.signals import send_metrics
 from entity_emailer.tests.utils import g_email
 from entity_emailer.utils import extract_email_subject_from_html_content, create_email_message, \
-    get_subscribed_email_addresses, get_from_email_address
+    get_subscribed_email_addresses, get_from_email_address, prefetch_subscribed_email_addresses
 
 
 class ExtractEmailSubjectFromHtmlContentTest(SimpleTestCase):
@@ -49,6 +55,36 @@ class ExtractEmailSubjectFromHtmlContentTest(SimpleTestCase):
         ))
         self.assertEqual(subject, 'This is reallly long content that is gre...')
 
+    def test_title_with_entities(self):
+        subject = extract_email_subject_from_html_content(
+            '<html><head><title>Tom &amp; Jerry&#39;s</title></head><body>Body</body></html>'
+        )
+        self.assertEqual(subject, "Tom & Jerry's")
+
+    def test_empty_title_block(self):
+        subject = extract_email_subject_from_html_content('<head><title> </title></head>')
+        self.assertEqual(subject, '<head><title> </title></head>')
+
+    def test_title_after_head(self):
+        subject = extract_email_subject_from_html_content('<head></head><title>Hello!</title>')
+        self.assertEqual(subject, '<head></head><title>Hello!</title>')
+
+    def test_title_after_body(self):
+        subject = extract_email_subject_from_html_content('<body><title>Hello!</title></body>')
+        self.assertEqual(subject, '<body><title>Hello!</title></body>')
+
+    def test_title_after_other_head_tags(self):
+        subject = extract_email_subject_from_html_content(
+            '<head><style>p { color: red; }</style><title>Hello!</title></head>'
+        )
+        self.assertEqual(subject, 'Hello!')
+
+    def test_stops_parsing_after_title(self):
+        with patch.object(HTMLParser, 'handle_data', autospec=True) as handle_data_mock:
+            extract_email_subject_from_html_content('<title>Hi</title><p>Never parsed</p>')
+
+        handle_data_mock.assert_not_called()
+
 
 class ConvertEventsToEmailsTest(TestCase):
     def setUp(self):
@@ -81,6 +117,26 @@ class ConvertEventsToEmailsTest(TestCase):
 
         self.assertEqual(email.from_address, 'test@example.com')
 
+    def test_unsubscribed_after_previous_conversion(self):
+        """
+        Verifies that an entity that unsubscribes between two conversions is not a recipient of the second
+        """
+        source = G(Source)
+        e = G(Entity)
+        G(Subscription, entity=e, source=source, medium=self.email_medium, only_following=False, sub_entity_kind=None)
+        email_context = {
+            'entity_emailer_template': 'template',
+            'entity_emailer_subject': 'hi',
+        }
+        G(EventActor, event=G(Event, source=source, context=email_context), entity=e)
+        EntityEmailerInterface.convert_events_to_emails()
+
+        G(Unsubscription, entity=e, source=source, medium=self.email_medium)
+        G(EventActor, event=G(Event, source=source, context=email_context), entity=e)
+        EntityEmailerInterface.convert_events_to_emails()
+
+        self.assertEqual(Email.objects.count(), 1)
+
     def test_custom_from_email(self):
         source = G(Source)
         e = G(Entity)
@@ -355,6 +411,112 @@ class ConvertEventsToEmailsTest(TestCase):
         self.assertEqual(email.subject, '')
         self.assertEqual(email.scheduled, datetime(2013, 1, 2))
 
+    def test_bulk_converts_in_batches(self):
+        source = G(Source)
+        e = G(Entity)
+        G(Subscription, entity=e, source=source, medium=self.email_medium, only_following=False)
+        email_context = {
+            'entity_emailer_template': 'template',
+            'entity_emailer_subject': 'hi',
+        }
+        events = [G(Event, source=source, context=email_context) for i in range(3)]
+        # An event without any targets is still marked as seen
+        events.append(G(Event, source=G(Source), context=email_context))
+
+        with patch.object(Email.objects, 'create_emails', wraps=Email.objects.create_emails) as create_emails_mock:
+            EntityEmailerInterface.bulk_convert_events_to_emails(batch_size=2)
+
+        self.assertEqual(
+            [[params['event'].id for params in call[0][0]] for call in create_emails_mock.call_args_list],
+            [[events[0].id, events[1].id], [events[2].id]]
+        )
+        self.assertEqual(
+            set(Email.objects.values_list('event_id', flat=True)),
+            {events[0].id, events[1].id, events[2].id}
+        )
+        self.assertFalse(self.email_medium.get_filtered_events(seen=False).exists())
+
+    @freeze_time('2013-1-2')
+    def test_bulk_converts_events_with_the_same_time_in_batches(self):
+        source = G(Source)
+        e = G(Entity)
+        G(Subscription, entity=e, source=source, medium=self.email_medium, only_following=False)
+        email_context = {
+            'entity_emailer_template': 'template',
+            'entity_emailer_subject': 'hi',
+        }
+        events = [G(Event, source=source, context=email_context) for i in range(3)]
+
+        patch_target_ids = patch.object(
+            EntityEmailerInterface, 'get_event_target_ids', wraps=EntityEmailerInterface.get_event_target_ids
+        )
+        patch_subscriptions = patch.object(
+            EntityEmailerInterface, 'get_subscriptions', wraps=EntityEmailerInterface.get_subscriptions
+        )
+        with patch.object(Email.objects, 'create_emails', wraps=Email.objects.create_emails) as create_emails_mock, \
+                patch_target_ids as target_ids_mock, patch_subscriptions as subscriptions_mock:
+            EntityEmailerInterface.bulk_convert_events_to_emails(batch_size=2)
+
+        self.assertEqual(
+            [[params['event'].id for params in call[0][0]] for call in create_emails_mock.call_args_list],
+            [[events[0].id, events[1].id], [events[2].id]]
+        )
+        self.assertEqual(Email.objects.count(), 3)
+
+        # Only the targets of the events of each batch are found, from subscriptions that are fetched once
+        self.assertEqual([call[0][1].id for call in target_ids_mock.call_args_list], [event.id for event in events])
+        self.assertEqual(1, subscriptions_mock.call_count)
+
+    def test_bulk_convert_excludes_unsubscribed_entities(self):
+        source = G(Source)
+        e = G(Entity)
+        unsubscribed_e = G(Entity)
+        for entity in [e, unsubscribed_e]:
+            G(Subscription, entity=entity, source=source, medium=self.email_medium, only_following=False)
+        G(Unsubscription, entity=unsubscribed_e, source=source, medium=self.email_medium)
+        event = G(Event, source=source, context={})
+
+        EntityEmailerInterface.bulk_convert_events_to_emails()
+
+        email = Email.objects.get()
+        self.assertEqual(email.event, event)
+        self.assertEqual(set(email.recipients.all()), {e})
+
+    @override_settings(ENTITY_EMAILER_CONVERT_BATCH_SIZE=1)
+    def test_bulk_convert_failure_keeps_committed_batches(self):
+        """
+        Verifies that a failure part way through only leaves the events of the failed batch to be converted again
+        """
+        source = G(Source)
+        e = G(Entity)
+        G(Subscription, entity=e, source=source, medium=self.email_medium, only_following=False)
+        email_context = {
+            'entity_emailer_template': 'template',
+            'entity_emailer_subject': 'hi',
+        }
+        events = [G(Event, source=source, context=email_context) for i in range(2)]
+
+        create_emails = Email.objects.create_emails
+
+        def fail_second_batch(email_params_list, **kwargs):
+            if email_params_list[0]['event'] == events[1]:
+                raise Exception('test')
+            return create_emails(email_params_list, **kwargs)
+
+        with patch.object(Email.objects, 'create_emails', side_effect=fail_second_batch):
+            with self.assertRaises(Exception):
+                EntityEmailerInterface.bulk_convert_events_to_emails()
+
+        self.assertEqual(list(Email.objects.values_list('event_id', flat=True)), [events[0].id])
+        self.assertEqual(list(self.email_medium.get_filtered_events(seen=False)), [events[1]])
+
+        EntityEmailerInterface.bulk_convert_events_to_emails()
+
+        self.assertEqual(
+            sorted(Email.objects.values_list('event_id', flat=True)),
+            [events[0].id, events[1].id]
+        )
+
     @freeze_time('2013-1-2')
     def test_multiple_events_only_following_true(self):
         source = G(Source)
@@ -453,6 +615,7 @@ class SendUnsentScheduledEmailsTest(TestCase):
                 'test': 'test',
                 'entity_emailer_id': str(email.view_uid)
             })
+            self.assertIs(type(kwargs['context']), dict)
             self.assertIsInstance(kwargs['message'], EmailMultiAlternatives)
 
     @override_settings(DISABLE_DURABILITY_CHECKING=True)
@@ -652,6 +815,790 @@ class SendUnsentScheduledEmailsTest(TestCase):
             actual_failed_email.exception
         )
 
+    @override_settings(DISABLE_DURABILITY_CHECKING=True)
+    @patch('entity_emailer.interface.context_loader')
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_sends_in_batches(self, render_mock, address_mock, context_loader_mock):
+        """
+        Verifies that emails are loaded, rendered and sent in batches of the given size over one connection
+        """
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.return_value = ['test1@example.com']
+        emails = [
+            g_email(context={}, scheduled=datetime(2014, 1, 1)),
+            g_email(context={}, scheduled=datetime.min),
+            g_email(context={}, scheduled=datetime(2014, 1, 1)),
+        ]
+
+        with patch(settings.EMAIL_BACKEND) as mock_connection:
+            EntityEmailerInterface.send_unsent_scheduled_emails(batch_size=2)
+
+            # Only one connection is opened for all of the batches
+            self.assertEqual(1, mock_connection.call_count)
+            self.assertEqual(3, mock_connection.return_value.__enter__.return_value.send_messages.call_count)
+
+        # The contexts are loaded once per batch in (scheduled, id) order
+        self.assertEqual(
+            [[e.id for e in call[0][0]] for call in context_loader_mock.load_contexts_and_renderers.call_args_list],
+            [[emails[1].event_id, emails[0].event_id], [emails[2].event_id]]
+        )
+        self.assertEqual(3, Email.objects.filter(sent__isnull=False).count())
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True, ENTITY_EMAILER_SEND_BATCH_SIZE=1)
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_batch_size_setting_does_not_retry_failures_in_same_run(self, render_mock, address_mock):
+        """
+        Verifies that the batch size setting is used and that an email that fails in one batch is not
+        picked up again by a later batch of the same run
+        """
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.return_value = ['test1@example.com']
+        failed_email = g_email(context={}, scheduled=datetime.min)
+        g_email(context={}, scheduled=datetime.min)
+
+        with patch(settings.EMAIL_BACKEND) as mock_connection:
+            mock_connection.return_value.__enter__.return_value.send_messages.side_effect = [
+                Exception('test'),
+                None,
+            ]
+            EntityEmailerInterface.send_unsent_scheduled_emails()
+
+            self.assertEqual(2, mock_connection.return_value.__enter__.return_value.send_messages.call_count)
+
+        self.assertEqual(1, Email.objects.filter(sent__isnull=False).count())
+        self.assertEqual(Email.objects.get(num_tries=1).id, failed_email.id)
+
+    @override_settings(
+        DISABLE_DURABILITY_CHECKING=True, ENTITY_EMAILER_SEND_BATCH_SIZE=1, ENTITY_EMAILER_EMAIL_ADDRESS_CACHE_SIZE=1,
+    )
+    @patch.object(Event, 'render', spec_set=True)
+    def test_email_address_cache_is_bounded(self, render_mock):
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        e1 = G(Entity, entity_meta={'email': 'hello1@hello.com'})
+        e2 = G(Entity, entity_meta={'email': 'hello2@hello.com'})
+        e3 = G(Entity, entity_meta={'email': 'hello3@hello.com'})
+        g_email(recipients=[e1], context={}, scheduled=datetime.min)
+        g_email(recipients=[e1, e2], context={}, scheduled=datetime.min)
+        g_email(recipients=[e3], context={}, scheduled=datetime.min)
+
+        cache_sizes = []
+
+        def prefetch(emails, entity_email_addresses):
+            cache_sizes.append(len(entity_email_addresses))
+            prefetch_subscribed_email_addresses(emails, entity_email_addresses)
+
+        with patch('entity_emailer.interface.prefetch_subscribed_email_addresses', side_effect=prefetch):
+            EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        # The addresses are kept across batches until there are more than the cache size, and then cleared
+        self.assertEqual(cache_sizes, [0, 1, 0])
+        self.assertEqual([message.to for message in mail.outbox], [
+            ['hello1@hello.com'], ['hello1@hello.com', 'hello2@hello.com'], ['hello3@hello.com'],
+        ])
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True)
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_batch_size_multiple_of_emails(self, render_mock, address_mock):
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.return_value = ['test1@example.com']
+        g_email(context={}, scheduled=datetime.min)
+        g_email(context={}, scheduled=datetime.min)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails(batch_size=1)
+
+        self.assertEqual(2, len(mail.outbox))
+        self.assertEqual(2, Email.objects.filter(sent__isnull=False).count())
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True)
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_sends_with_multiple_workers(self, render_mock, address_mock):
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.return_value = ['test1@example.com']
+        for i in range(5):
+            g_email(context={}, scheduled=datetime.min)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails(num_workers=3)
+
+        self.assertEqual(5, len(mail.outbox))
+        self.assertEqual(5, Email.objects.filter(sent__isnull=False).count())
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True)
+    @patch('entity_emailer.interface.get_subscribed_email_addresses', lambda email: ['test1@example.com'])
+    @patch.object(Event, 'render', spec_set=True)
+    def test_releases_sent_batches(self, render_mock):
+        """
+        Verifies that the emails of a batch are no longer referenced once the next batch is claimed
+        """
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        for _ in range(3):
+            g_email(context={}, scheduled=datetime.min)
+
+        sent_batches = []
+        claim_unsent_emails = EntityEmailerInterface.claim_unsent_emails
+        send_email_batch = EntityEmailerInterface.send_email_batch
+
+        def claim_batch(*args):
+            gc.collect()
+            self.assertTrue(all(email_ref() is None for batch in sent_batches for email_ref in batch))
+            return claim_unsent_emails(*args)
+
+        def record_batch(to_send, *args):
+            sent_batches.append([weakref.ref(email) for email in to_send])
+            send_email_batch(to_send, *args)
+
+        # Replace rather than mock the functions that are passed emails, since a mock keeps references to its calls
+        with patch.object(EntityEmailerInterface, 'claim_unsent_emails', claim_batch), \
+                patch.object(EntityEmailerInterface, 'send_email_batch', record_batch):
+            EntityEmailerInterface.send_unsent_scheduled_emails(batch_size=1)
+
+        self.assertEqual(3, len(sent_batches))
+        self.assertEqual(3, len(mail.outbox))
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True, ENTITY_EMAILER_SEND_BATCH_SIZE=2)
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_default_batch_size(self, render_mock, address_mock):
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.return_value = ['test1@example.com']
+        for _ in range(3):
+            g_email(context={}, scheduled=datetime.min)
+
+        with patch.object(
+            EntityEmailerInterface, 'claim_unsent_emails', wraps=EntityEmailerInterface.claim_unsent_emails
+        ) as claim_mock:
+            EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(2, claim_mock.call_count)
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True)
+    def test_default_batch_size_without_setting(self):
+        with patch.object(EntityEmailerInterface, 'claim_unsent_emails', return_value=[]) as claim_mock:
+            EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(claim_mock.call_args[0][1], 500)
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True, ENTITY_EMAILER_SEND_MESSAGES_BATCH_SIZE=2)
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_sends_messages_in_batches(self, render_mock, address_mock):
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.return_value = ['test1@example.com']
+        emails = [g_email(context={}, scheduled=datetime.min, subject=str(i)) for i in range(5)]
+
+        def send_messages(messages):
+            if messages[0].subject == '2':
+                raise Exception('test')
+            return len(messages)
+
+        with patch(settings.EMAIL_BACKEND) as mock_connection:
+            send_mock = mock_connection.return_value.__enter__.return_value.send_messages
+            send_mock.side_effect = send_messages
+
+            EntityEmailerInterface.send_unsent_scheduled_emails()
+
+            self.assertEqual(
+                [[message.subject for message in call[0][0]] for call in send_mock.call_args_list],
+                [['0', '1'], ['2', '3'], ['4']],
+            )
+
+        # Every email of the failed batch is failed
+        self.assertEqual(
+            [(email.subject, email.sent is None, email.num_tries) for email in Email.objects.order_by('id')],
+            [('0', False, 0), ('1', False, 0), ('2', True, 1), ('3', True, 1), ('4', False, 0)],
+        )
+        self.assertEqual(len(emails), Email.objects.count())
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True, ENTITY_EMAILER_MIME_CACHE=True)
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_mime_cache(self, render_mock, address_mock):
+        render_mock.return_value = ['This is a test text email.', '<p>This is a test html email.</p>']
+        address_mock.side_effect = lambda email: ['test{0}@example.com'.format(email.id)]
+        email = g_email(context={}, scheduled=datetime.min)
+        g_email(event=email.event, scheduled=datetime.min)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(2, len(mail.outbox))
+        messages = [message.message() for message in mail.outbox]
+        self.assertIs(messages[0].get_payload()[1], messages[1].get_payload()[1])
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True, ENTITY_EMAILER_MERGE_IDENTICAL_EMAILS=True)
+    @patch('django.core.mail.backends.locmem.EmailBackend.supports_merge_data', True, create=True)
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', autospec=True)
+    def test_merges_identical_emails(self, render_mock, address_mock):
+        render_mock.side_effect = lambda event, medium: ['<p>{0}</p>'.format(event.id), 'text']
+        address_mock.side_effect = lambda email: ['test{0}@example.com'.format(email.id)]
+        email = g_email(context={}, scheduled=datetime.min, subject='hi')
+        same_emails = [g_email(event=email.event, scheduled=datetime.min, subject='hi') for _ in range(2)]
+        other_subject_email = g_email(event=email.event, scheduled=datetime.min, subject='hello')
+        other_event_email = g_email(context={}, scheduled=datetime.min, subject='hi')
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(
+            [(message.subject, message.to) for message in mail.outbox],
+            [
+                ('hi', ['test{0}@example.com'.format(e.id) for e in [email] + same_emails]),
+                ('hello', ['test{0}@example.com'.format(other_subject_email.id)]),
+                ('hi', ['test{0}@example.com'.format(other_event_email.id)]),
+            ]
+        )
+        self.assertEqual(mail.outbox[0].merge_data, {address: {} for address in mail.outbox[0].to})
+        self.assertEqual(5, Email.objects.filter(sent__isnull=False).count())
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True, ENTITY_EMAILER_MERGE_IDENTICAL_EMAILS=True)
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_does_not_merge_without_backend_support(self, render_mock, address_mock):
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.side_effect = lambda email: ['test{0}@example.com'.format(email.id)]
+        email = g_email(context={}, scheduled=datetime.min, subject='hi')
+        g_email(event=email.event, scheduled=datetime.min, subject='hi')
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        # The locmem backend does not support merge_data, so every recipient gets their own message
+        self.assertEqual([len(message.to) for message in mail.outbox], [1, 1])
+        self.assertFalse(any(hasattr(message, 'merge_data') for message in mail.outbox))
+
+    @override_settings(
+        DISABLE_DURABILITY_CHECKING=True, ENTITY_EMAILER_MERGE_IDENTICAL_EMAILS=True,
+        ENTITY_EMAILER_MERGE_MAX_RECIPIENTS=4,
+    )
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_merge_max_recipients(self, render_mock, address_mock):
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.return_value = ['test1@example.com', 'test2@example.com']
+        email = g_email(context={}, scheduled=datetime.min, subject='hi')
+        g_email(event=email.event, scheduled=datetime.min, subject='hi')
+        g_email(event=email.event, scheduled=datetime.min, subject='hi')
+
+        with patch(settings.EMAIL_BACKEND) as mock_connection:
+            send_mock = mock_connection.return_value.__enter__.return_value.send_messages
+            send_mock.side_effect = [Exception('test'), 1]
+
+            EntityEmailerInterface.send_unsent_scheduled_emails()
+
+            self.assertEqual([len(call[0][0][0].to) for call in send_mock.call_args_list], [4, 2])
+
+        # Every email of the failed message is failed
+        self.assertEqual(
+            [(email.sent is None, email.num_tries) for email in Email.objects.order_by('id')],
+            [(True, 1), (True, 1), (False, 0)],
+        )
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True, ENTITY_EMAILER_SEND_WORKERS=2)
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_worker_exceptions_are_isolated(self, render_mock, address_mock):
+        """
+        Verifies that an exception raised by one worker's connection only fails the email being sent
+        """
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.return_value = ['test1@example.com']
+        emails = [
+            g_email(context={}, scheduled=datetime.min, subject='0'),
+            g_email(context={}, scheduled=datetime.min, subject='1'),
+            g_email(context={}, scheduled=datetime.min, subject='2'),
+        ]
+
+        def send_messages(messages):
+            if messages[0].subject == '1':
+                raise Exception('test')
+
+        with patch(settings.EMAIL_BACKEND) as mock_connection:
+            mock_connection.return_value.__enter__.return_value.send_messages.side_effect = send_messages
+
+            EntityEmailerInterface.send_unsent_scheduled_emails()
+
+            # A connection is opened for each worker
+            self.assertEqual(2, mock_connection.call_count)
+            self.assertEqual(3, mock_connection.return_value.__enter__.return_value.send_messages.call_count)
+
+        self.assertEqual(
+            set(Email.objects.filter(sent__isnull=False).values_list('id', flat=True)),
+            {emails[0].id, emails[2].id}
+        )
+        self.assertEqual(Email.objects.get(num_tries=1, exception='test').id, emails[1].id)
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True)
+    @patch('entity_emailer.interface.email_exception')
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_saves_outcomes_in_bulk(self, render_mock, address_mock, mock_email_exception):
+        """
+        Verifies that the outcomes of a batch are saved with one update for the sent emails and one for the failures
+        """
+        render_mock.side_effect = [
+            Exception('test'),
+            ['<p>This is a test html email.</p>', 'This is a test text email.'],
+            ['<p>This is a test html email.</p>', 'This is a test text email.'],
+            ['<p>This is a test html email.</p>', 'This is a test text email.'],
+        ]
+        address_mock.side_effect = [
+            ['test1@example.com'],
+            ['test1@example.com'],
+            ['test1@example.com'],
+            ['test1@example.com'],
+            [],
+        ]
+        for i in range(5):
+            g_email(context={}, scheduled=datetime.min)
+
+        with patch(settings.EMAIL_BACKEND) as mock_connection:
+            mock_connection.return_value.__enter__.return_value.send_messages.side_effect = [
+                None,
+                Exception('test'),
+                None,
+            ]
+            with CaptureQueriesContext(connection) as queries:
+                EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        updates = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(1, len([sql for sql in updates if '"sent"' in sql]))
+        self.assertEqual(1, len([sql for sql in updates if '"num_tries"' in sql]))
+        self.assertEqual(3, Email.objects.filter(sent=datetime(2014, 1, 5)).count())
+        self.assertEqual(2, Email.objects.filter(num_tries=1, sent__isnull=True).count())
+        self.assertEqual(2, mock_email_exception.send.call_count)
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True)
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_renders_shared_events_once(self, render_mock, address_mock):
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.return_value = ['test1@example.com']
+        email = g_email(context={}, scheduled=datetime.min)
+        g_email(event=email.event, scheduled=datetime.min)
+        g_email(event=email.event, scheduled=datetime.min)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        # The second email is rendered to verify that the first rendering may be shared by the third
+        self.assertEqual(2, render_mock.call_count)
+        self.assertEqual(3, len(mail.outbox))
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True, ENTITY_EMAILER_RENDER_CACHE=False)
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_render_cache_disabled(self, render_mock, address_mock):
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.return_value = ['test1@example.com']
+        email = g_email(context={}, scheduled=datetime.min)
+        g_email(event=email.event, scheduled=datetime.min)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(2, render_mock.call_count)
+        self.assertEqual(2, len(mail.outbox))
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True)
+    @patch.object(Event, 'render', spec_set=True)
+    def test_sends_to_subscribed_email_addresses(self, render_mock):
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        e1 = G(Entity, entity_meta={'email': 'hello1@hello.com'})
+        e2 = G(Entity, entity_meta={'email': 'hello2@hello.com'})
+        e3 = G(Entity, entity_meta={})
+        g_email(recipients=[e1, e2], context={}, scheduled=datetime.min)
+        g_email(recipients=[e3], context={}, scheduled=datetime.min)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails(batch_size=1)
+
+        self.assertEqual(1, len(mail.outbox))
+        self.assertEqual(set(mail.outbox[0].to), {'hello1@hello.com', 'hello2@hello.com'})
+        self.assertEqual(2, Email.objects.filter(sent__isnull=False).count())
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True, ENTITY_EMAILER_RATE_LIMIT=1)
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_releases_emails_once_the_rate_limit_is_used_up(self, render_mock, address_mock):
+        """
+        Verifies that a deep backlog is left as it is rather than rescheduled once the global rate limit is used up
+        """
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.return_value = ['test1@example.com']
+        emails = [g_email(context={}, scheduled=datetime.min) for _ in range(50)]
+
+        patch_claim = patch.object(
+            EntityEmailerInterface, 'claim_unsent_emails', wraps=EntityEmailerInterface.claim_unsent_emails
+        )
+        with patch('entity_emailer.rate_limit.time.monotonic', return_value=100), patch_claim as claim_mock:
+            num_emails = EntityEmailerInterface.send_unsent_scheduled_emails(batch_size=10)
+
+        # Only the first batch is claimed, and the rest of it is released without being rescheduled
+        self.assertEqual(1, claim_mock.call_count)
+        self.assertEqual(10, num_emails)
+
+        self.assertEqual(1, len(mail.outbox))
+        self.assertIsNotNone(Email.objects.get(id=emails[0].id).sent)
+        self.assertEqual(
+            49,
+            Email.objects.filter(
+                sent__isnull=True, claimed_until__isnull=True, scheduled=datetime.min, num_tries=0
+            ).count()
+        )
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True, ENTITY_EMAILER_DOMAIN_RATE_LIMITS={'example.com': 1})
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_defers_domain_rate_limited_emails(self, render_mock, address_mock):
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.side_effect = lambda email: [
+            'test@other.com' if email.id == other_email.id else 'test@example.com'
+        ]
+        sent_email = g_email(context={}, scheduled=datetime.min)
+        deferred_emails = [g_email(context={}, scheduled=datetime.min) for _ in range(2)]
+        other_email = g_email(context={}, scheduled=datetime.min)
+
+        with patch('entity_emailer.rate_limit.time.monotonic', return_value=100):
+            EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertEqual(2, len(mail.outbox))
+        self.assertEqual(2, Email.objects.filter(id__in=[sent_email.id, other_email.id], sent__isnull=False).count())
+
+        # The deferred emails are spread out at the rate of their domain
+        deferred_emails = Email.objects.filter(id__in=[email.id for email in deferred_emails]).order_by('id')
+        self.assertEqual(
+            [email.scheduled for email in deferred_emails],
+            [datetime(2014, 1, 5, 0, 0, 1), datetime(2014, 1, 5, 0, 0, 2)]
+        )
+        for email in deferred_emails:
+            self.assertIsNone(email.sent)
+            self.assertIsNone(email.claimed_until)
+            self.assertEqual(email.num_tries, 0)
+
+    @override_settings(
+        DISABLE_DURABILITY_CHECKING=True, ENTITY_EMAILER_RETRY_BASE_DELAY=30, ENTITY_EMAILER_RETRY_JITTER=0
+    )
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_backs_off_failed_emails(self, render_mock, address_mock):
+        render_mock.side_effect = Exception('render failed')
+        address_mock.return_value = ['test1@example.com']
+        email = g_email(context={}, scheduled=datetime.min)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+        email.refresh_from_db()
+        self.assertEqual(email.num_tries, 1)
+        self.assertEqual(email.scheduled, datetime(2014, 1, 5, 0, 0, 30))
+
+        # The email is not retried until it is due again
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+        email.refresh_from_db()
+        self.assertEqual(email.num_tries, 1)
+
+        with freeze_time('2014-01-05 00:00:30'):
+            EntityEmailerInterface.send_unsent_scheduled_emails()
+        email.refresh_from_db()
+        self.assertEqual(email.num_tries, 2)
+        self.assertEqual(email.scheduled, datetime(2014, 1, 5, 0, 1, 30))
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True)
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_returns_number_of_emails(self, render_mock, address_mock):
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.return_value = ['test1@example.com']
+        g_email(context={}, scheduled=datetime.min)
+        g_email(context={}, scheduled=datetime.min)
+
+        self.assertEqual(2, EntityEmailerInterface.send_unsent_scheduled_emails(batch_size=1))
+
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_send_due_emails_should_stop(self, render_mock, address_mock):
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.return_value = ['test1@example.com']
+        g_email(context={}, scheduled=datetime.min)
+        g_email(context={}, scheduled=datetime.min)
+
+        with mail.get_connection() as connection:
+            num_emails = EntityEmailerInterface.send_due_emails([connection], batch_size=1, should_stop=lambda: True)
+
+        self.assertEqual(1, num_emails)
+        self.assertEqual(1, len(mail.outbox))
+        self.assertEqual(1, Email.objects.filter(sent__isnull=True).count())
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True)
+    @patch.object(Event, 'render', spec_set=True)
+    def test_sends_metrics(self, render_mock):
+        render_mock.side_effect = [
+            Exception('render failed'),
+            ['<p>This is a test html email.</p>', 'This is a test text email.'],
+        ]
+        e1 = G(Entity, entity_meta={'email': 'hello1@hello.com'})
+        e2 = G(Entity, entity_meta={})
+        g_email(recipients=[e1], context={}, scheduled=datetime.min)
+        g_email(recipients=[e1], context={}, scheduled=datetime.min)
+        g_email(recipients=[e2], context={}, scheduled=datetime.min)
+
+        received = []
+
+        def receiver(sender, metrics, **kwargs):
+            received.append(metrics)
+
+        send_metrics.connect(receiver)
+        try:
+            EntityEmailerInterface.send_unsent_scheduled_emails(batch_size=2)
+        finally:
+            send_metrics.disconnect(receiver)
+
+        self.assertEqual(1, len(received))
+        metrics = received[0].as_dict()
+        self.assertEqual(
+            {key: value for key, value in metrics['counts'].items() if key != 'bytes_sent'},
+            {'considered': 3, 'skipped': 1, 'rendered': 1, 'sent': 1, 'failed': 1},
+        )
+        self.assertEqual(
+            metrics['counts']['bytes_sent'],
+            len('This is a test text email.') + len('<p>This is a test html email.</p>'),
+        )
+        self.assertEqual(
+            set(metrics['timings']),
+            {
+                'claim', 'load_contexts', 'resolve_addresses', 'render', 'extract_subject', 'deliver',
+                'save_outcomes', 'total',
+            }
+        )
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True)
+    @patch.object(send_metrics, 'send', spec_set=True)
+    def test_metrics_not_sent_without_receivers(self, send_mock):
+        EntityEmailerInterface.send_unsent_scheduled_emails()
+
+        self.assertFalse(send_mock.called)
+
+
+class MergeMessagesTest(SimpleTestCase):
+    def test_merges_only_identical_headers_and_attachments(self):
+        messages = [EmailMultiAlternatives('hi', 'text', 'from@example.com', ['test0@example.com'])]
+        messages.append(EmailMultiAlternatives('hi', 'text', 'from@example.com', ['test1@example.com']))
+        messages.append(EmailMultiAlternatives('hi', 'text', 'from@example.com', ['test2@example.com'], cc=['a']))
+        messages.append(EmailMultiAlternatives('hi', 'text', 'from@example.com', ['test3@example.com'], bcc=['a']))
+        messages.append(
+            EmailMultiAlternatives('hi', 'text', 'from@example.com', ['test4@example.com'], reply_to=['a'])
+        )
+        messages.append(
+            EmailMultiAlternatives('hi', 'text', 'from@example.com', ['test5@example.com'], headers={'X-Id': '5'})
+        )
+        messages.append(EmailMultiAlternatives('hi', 'text', 'from@example.com', ['test6@example.com']))
+        messages[-1].attach('file.txt', 'content', 'text/plain')
+
+        merged = EntityEmailerInterface.merge_messages(
+            [{'message': message, 'model': i} for i, message in enumerate(messages)]
+        )
+
+        self.assertEqual([message['models'] for message in merged], [[0, 1], [2], [3], [4], [5], [6]])
+
+    def test_supports_merge_data(self):
+        anymail_backend = type('EmailBackend', (), {'__module__': 'anymail.backends.test'})()
+        declared_backend = type('EmailBackend', (), {'supports_merge_data': True})()
+
+        self.assertTrue(EntityEmailerInterface.supports_merge_data(anymail_backend))
+        self.assertTrue(EntityEmailerInterface.supports_merge_data(declared_backend))
+        self.assertFalse(EntityEmailerInterface.supports_merge_data(mail.get_connection()))
+
+
+@freeze_time('2014-01-05')
+class ClaimUnsentEmailsTest(TestCase):
+    def test_claims_due_emails(self):
+        email = g_email(context={}, scheduled=datetime.min)
+        g_email(context={}, scheduled=datetime(2014, 1, 6))
+        g_email(context={}, scheduled=datetime.min, sent=datetime.min)
+
+        claimed = EntityEmailerInterface.claim_unsent_emails(datetime.utcnow())
+
+        self.assertEqual(claimed, [email])
+        self.assertEqual(Email.objects.get(id=email.id).claimed_until, datetime(2014, 1, 5, 0, 10))
+
+    def test_skips_claimed_emails(self):
+        emails = [
+            g_email(context={}, scheduled=datetime.min),
+            g_email(context={}, scheduled=datetime.min),
+            g_email(context={}, scheduled=datetime.min),
+        ]
+
+        self.assertEqual(EntityEmailerInterface.claim_unsent_emails(datetime.utcnow(), 2), emails[:2])
+        self.assertEqual(EntityEmailerInterface.claim_unsent_emails(datetime.utcnow(), 2), emails[2:])
+        self.assertEqual(EntityEmailerInterface.claim_unsent_emails(datetime.utcnow(), 2), [])
+
+    @override_settings(ENTITY_EMAILER_CLAIM_LEASE_SECONDS=60)
+    def test_reclaims_expired_claims(self):
+        email = g_email(context={}, scheduled=datetime.min, claimed_until=datetime(2014, 1, 4, 23, 59))
+        g_email(context={}, scheduled=datetime.min, claimed_until=datetime(2014, 1, 5, 0, 1))
+
+        self.assertEqual(EntityEmailerInterface.claim_unsent_emails(datetime.utcnow()), [email])
+        self.assertEqual(Email.objects.get(id=email.id).claimed_until, datetime(2014, 1, 5, 0, 1))
+
+    @override_settings(ENTITY_EMAILER_CLAIM_LEASE_SECONDS=60, ENTITY_EMAILER_CLAIM_LEASE_SECONDS_PER_EMAIL=300)
+    def test_lease_is_sized_from_the_batch(self):
+        for i in range(3):
+            g_email(context={}, scheduled=datetime.min)
+
+        EntityEmailerInterface.claim_unsent_emails(datetime.utcnow(), 2)
+
+        self.assertEqual(
+            sorted(Email.objects.values_list('claimed_until', flat=True), key=lambda claimed: claimed or datetime.min),
+            [None, datetime(2014, 1, 5, 0, 10), datetime(2014, 1, 5, 0, 10)],
+        )
+
+    def test_claims_with_skip_locked(self):
+        if not connection.features.has_select_for_update_skip_locked:  # pragma: no cover
+            self.skipTest('Database does not support SELECT ... FOR UPDATE SKIP LOCKED')
+
+        g_email(context={}, scheduled=datetime.min)
+
+        with CaptureQueriesContext(connection) as queries:
+            EntityEmailerInterface.claim_unsent_emails(datetime.utcnow())
+
+        self.assertIn('SKIP LOCKED', ' '.join(query['sql'] for query in queries.captured_queries))
+
+
+@freeze_time('2014-01-05')
+class SaveEmailOutcomesTest(TestCase):
+    def test_skips_emails_claimed_by_another_sender(self):
+        """
+        Verifies that the outcomes of emails whose leases expired and that were claimed again are not saved
+        """
+        for i in range(8):
+            g_email(context={}, scheduled=datetime.min)
+        emails = EntityEmailerInterface.claim_unsent_emails(datetime.utcnow())
+        reclaimed_emails = emails[1::2]
+        Email.objects.filter(id__in=[email.id for email in reclaimed_emails]).update(
+            claimed_until=datetime(2014, 1, 6)
+        )
+
+        EntityEmailerInterface.save_email_outcomes(
+            sent_emails=emails[0:2],
+            failed_emails=[(email, Exception('test')) for email in emails[2:4]],
+            current_time=datetime(2014, 1, 5),
+            deferred_emails=[(email, 10) for email in emails[4:6]],
+            released_emails=emails[6:8],
+        )
+
+        self.assertEqual(
+            [
+                (email.sent, email.num_tries, email.scheduled, email.claimed_until)
+                for email in Email.objects.order_by('id')
+            ],
+            [
+                (datetime(2014, 1, 5), 0, datetime.min, datetime(2014, 1, 5, 0, 10)),
+                (None, 0, datetime.min, datetime(2014, 1, 6)),
+                (None, 1, datetime.min, None),
+                (None, 0, datetime.min, datetime(2014, 1, 6)),
+                (None, 0, datetime(2014, 1, 5, 0, 0, 10), None),
+                (None, 0, datetime.min, datetime(2014, 1, 6)),
+                (None, 0, datetime.min, None),
+                (None, 0, datetime.min, datetime(2014, 1, 6)),
+            ]
+        )
+
+
+class ConcurrentClaimUnsentEmailsTest(TransactionTestCase):
+    def test_skips_emails_locked_by_another_sender(self):
+        """
+        Verifies that a sender does not wait on or claim emails that another sender is in the middle of claiming
+        """
+        if not connection.features.has_select_for_update_skip_locked:  # pragma: no cover
+            self.skipTest('Database does not support SELECT ... FOR UPDATE SKIP LOCKED')
+
+        locked_email = g_email(context={}, scheduled=datetime.min)
+        unlocked_email = g_email(context={}, scheduled=datetime.min)
+        locked = threading.Event()
+        release = threading.Event()
+
+        def lock_email():
+            try:
+                with transaction.atomic():
+                    list(Email.objects.select_for_update().filter(id=locked_email.id))
+                    locked.set()
+                    release.wait(10)
+            finally:
+                connections.close_all()
+
+        thread = threading.Thread(target=lock_email)
+        thread.start()
+        try:
+            locked.wait(10)
+            claimed = EntityEmailerInterface.claim_unsent_emails(datetime.utcnow())
+        finally:
+            release.set()
+            thread.join()
+
+        self.assertEqual(claimed, [unlocked_email])
+
+
+class LoadEventContextsTest(TestCase):
+    def setUp(self):
+        rendering_style = G(RenderingStyle)
+        self.medium = G(Medium, rendering_style=rendering_style, additional_context={})
+        source = G(Source)
+        G(
+            ContextRenderer, source=source, rendering_style=rendering_style,
+            text_template='Hi {{ name }} {{ entity_emailer_id }}', html_template='<b>{{ entity_emailer_id }}</b>',
+        )
+        self.event = G(Event, source=source, context={'name': 'Swansonbot'})
+
+    def test_loads_each_event_once(self):
+        other_event = G(Event, source=self.event.source, context={'name': 'Tammy'})
+        emails = [g_email(event=self.event), g_email(event=other_event), g_email(event=self.event)]
+        to_send = list(Email.objects.filter(id__in=[email.id for email in emails]).order_by('id'))
+
+        with patch(
+            'entity_emailer.interface.context_loader.load_contexts_and_renderers',
+            wraps=context_loader.load_contexts_and_renderers,
+        ) as load_mock:
+            EntityEmailerInterface.load_event_contexts(to_send, self.medium)
+
+        self.assertEqual(1, load_mock.call_count)
+        self.assertEqual([event.id for event in load_mock.call_args[0][0]], [self.event.id, other_event.id])
+
+        # The emails of an event share its loaded context
+        self.assertIs(to_send[0].event, to_send[2].event)
+        self.assertEqual(
+            [email.render(self.medium) for email in to_send],
+            [
+                ('Hi Swansonbot {0}'.format(emails[0].view_uid), '<b>{0}</b>'.format(emails[0].view_uid)),
+                ('Hi Tammy {0}'.format(emails[1].view_uid), '<b>{0}</b>'.format(emails[1].view_uid)),
+                ('Hi Swansonbot {0}'.format(emails[2].view_uid), '<b>{0}</b>'.format(emails[2].view_uid)),
+            ]
+        )
+        self.assertEqual(to_send[0].event.context, {'name': 'Swansonbot'})
+
+
+class SaveEmailExceptionTest(TestCase):
+    @patch('entity_emailer.interface.email_exception')
+    def test_saves_exception(self, mock_email_exception):
+        email = g_email(context={}, scheduled=datetime.min, claimed_until=datetime.min)
+        exception = Exception('test')
+
+        EntityEmailerInterface.save_email_exception(email, exception)
+
+        email = Email.objects.get(id=email.id)
+        self.assertEqual(email.exception, 'test')
+        self.assertEqual(email.num_tries, 1)
+        self.assertIsNone(email.claimed_until)
+        mock_email_exception.send.assert_called_once_with(sender=Email, email=email, exception=exception)
+        self.assertEqual(email.scheduled, datetime.min)
+
+    @freeze_time('2014-01-05')
+    @override_settings(ENTITY_EMAILER_RETRY_BASE_DELAY=60, ENTITY_EMAILER_RETRY_JITTER=0)
+    @patch('entity_emailer.interface.email_exception')
+    def test_backs_off_retries(self, mock_email_exception):
+        email = g_email(context={}, scheduled=datetime.min, num_tries=1)
+
+        EntityEmailerInterface.save_email_exception(email, Exception('test'))
+
+        email = Email.objects.get(id=email.id)
+        self.assertEqual(email.num_tries, 2)
+        self.assertEqual(email.scheduled, datetime(2014, 1, 5, 0, 2))
+
 
 class CreateEmailObjectTest(TestCase):
     def test_no_html(self):
@@ -669,6 +1616,61 @@ class CreateEmailObjectTest(TestCase):
         expected_alternatives = [('<html>A</html>', 'text/html')]
         self.assertEqual(mail.outbox[0].alternatives, expected_alternatives)
 
+    def test_html_mime_parts(self):
+        mime_parts = {}
+        emails = [
+            create_email_message(
+                [to_email], 'from@example.com', 'Subject', 'Email Body.', '<html>A</html>', mime_parts=mime_parts
+            )
+            for to_email in ['to1@example.com', 'to2@example.com']
+        ]
+        other_email = create_email_message(
+            ['to3@example.com'], 'from@example.com', 'Subject', 'Email Body.', '<html>B</html>', mime_parts=mime_parts
+        )
+        messages = [email.message() for email in emails + [other_email]]
+
+        # The html part is encoded once and shared by the messages with the same html
+        self.assertIs(messages[0].get_payload()[1], messages[1].get_payload()[1])
+        self.assertIsNot(messages[0].get_payload()[1], messages[2].get_payload()[1])
+        self.assertEqual(len(mime_parts), 2)
+        self.assertIn(b'To: to1@example.com', messages[0].as_bytes())
+        self.assertIn(b'To: to2@example.com', messages[1].as_bytes())
+        self.assertIn(b'<html>A</html>', messages[1].as_bytes())
+
+    def test_html_mime_parts_attachments(self):
+        email = create_email_message(
+            ['to@example.com'], 'from@example.com', 'Subject', 'Email Body.', '<html>A</html>', mime_parts={}
+        )
+        email.attach('file.bin', b'data', 'application/octet-stream')
+        email.send()
+
+        self.assertEqual(mail.outbox[0].attachments, [('file.bin', b'data', 'application/octet-stream')])
+
+    def test_html_mime_parts_text_attachments(self):
+        """
+        Verifies that text attachments are not shared between messages, since each message adds its own
+        Content-Disposition header to the part of an attachment
+        """
+        mime_parts = {}
+        emails = [
+            create_email_message(
+                [to_email], 'from@example.com', 'Subject', 'Email Body.', '<html>A</html>', mime_parts=mime_parts
+            )
+            for to_email in ['to1@example.com', 'to2@example.com', 'to3@example.com']
+        ]
+        for email in emails:
+            email.attach('report.csv', 'a,b', 'text/csv')
+            email.attach('page.html', '<html>A</html>', 'text/html')
+        messages = [email.message() for email in emails]
+
+        self.assertEqual(len(mime_parts), 1)
+        for message in messages:
+            alternatives, report, page = message.get_payload()
+            self.assertEqual(len(report.get_all('Content-Disposition')), 1)
+            self.assertEqual(len(page.get_all('Content-Disposition')), 1)
+            self.assertIsNone(alternatives.get_payload()[1]['Content-Disposition'])
+        self.assertIs(messages[0].get_payload()[0].get_payload()[1], messages[1].get_payload()[0].get_payload()[1])
+
 
 class GetSubscribedEmailAddressesTest(TestCase):
     def test_get_emails_default_settings(self):
@@ -702,6 +1704,55 @@ class GetSubscribedEmailAddressesTest(TestCase):
         self.assertEqual(set(addresses), set(['hello1@hello.com', 'hello2@hello.com']))
 
 
+class PrefetchSubscribedEmailAddressesTest(TestCase):
+    def test_prefetch_default_settings(self):
+        e1 = G(Entity, entity_meta={'email': 'hello1@hello.com'})
+        e2 = G(Entity, entity_meta={'email': 'hello2@hello.com'})
+        e3 = G(Entity, entity_meta={'email': ''})
+        e4 = G(Entity, entity_meta={})
+        e5 = G(Entity, entity_meta={'email': 'inactive@hello.com'}, is_active=False)
+        email = g_email(recipients=[e1, e2, e3, e4, e5], context={})
+        other_email = g_email(recipients=[e2], context={})
+        empty_email = g_email(recipients=[], context={})
+
+        with self.assertNumQueries(2):
+            prefetch_subscribed_email_addresses([email, other_email, empty_email])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(set(get_subscribed_email_addresses(email)), {'hello1@hello.com', 'hello2@hello.com'})
+            self.assertEqual(get_subscribed_email_addresses(other_email), ['hello2@hello.com'])
+            self.assertEqual(get_subscribed_email_addresses(empty_email), [])
+
+    @override_settings(ENTITY_EMAILER_EMAIL_KEY='email_address')
+    @override_settings(ENTITY_EMAILER_EXCLUDE_KEY='last_invite_time')
+    def test_prefetch_override_email_key(self):
+        e1 = G(Entity, entity_meta={'email_address': 'hello1@hello.com', 'last_invite_time': 1000})
+        e2 = G(Entity, entity_meta={'email_address': 'hello2@hello.com', 'last_invite_time': None})
+        e3 = G(Entity, entity_meta={'email_address': 'hello3@hello.com', 'last_invite_time': False})
+        e4 = G(Entity, entity_meta={'email_address': 'hello4@hello.com'})
+        email = g_email(recipients=[e1, e2, e3, e4], context={})
+
+        prefetch_subscribed_email_addresses([email])
+
+        self.assertEqual(get_subscribed_email_addresses(email), ['hello1@hello.com'])
+
+    def test_prefetch_shares_entity_email_addresses(self):
+        e1 = G(Entity, entity_meta={'email': 'hello1@hello.com'})
+        e2 = G(Entity, entity_meta={'email': 'hello2@hello.com'}, is_active=False)
+        email = g_email(recipients=[e1, e2], context={})
+        other_email = g_email(recipients=[e1, e2], context={})
+        entity_email_addresses = {}
+
+        prefetch_subscribed_email_addresses([email], entity_email_addresses)
+
+        # Entities that have already been fetched are not fetched again
+        with self.assertNumQueries(1):
+            prefetch_subscribed_email_addresses([other_email], entity_email_addresses)
+
+        self.assertEqual(entity_email_addresses, {e1.id: 'hello1@hello.com', e2.id: None})
+        self.assertEqual(get_subscribed_email_addresses(other_email), ['hello1@hello.com'])
+
+
 class GetFromEmailAddressTest(TestCase):
     def test_default_from_email(self):
         # settings.DEFAULT_FROM_EMAIL is already set to test@example.com
@@ -0,0 +1,167 @@
+import asyncio
+from datetime import datetime
+from io import StringIO
+import socket
+
+from aiosmtpd.controller import Controller
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import EmailMessage
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import override_settings
+from django_dynamic_fixture import G
+from entity_event.models import Event, Medium
+from unittest.mock import patch
+
+from entity_emailer import async_delivery
+from entity_emailer.async_delivery import AsyncConnectionPool
+from entity_emailer.interface import EntityEmailerInterface
+from entity_emailer.models import Email
+from entity_emailer.tests.utils import g_email
+
+
+class MessageHandler(object):
+    """
+    Collects the messages received by a local SMTP server
+    """
+    def __init__(self):
+        self.envelopes = []
+
+    async def handle_DATA(self, server, session, envelope):
+        if 'reject@example.com' in envelope.rcpt_tos:
+            return '554 Transaction failed'
+        self.envelopes.append(envelope)
+        return '250 Message accepted for delivery'
+
+
+def get_unused_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class SMTPServerMixin(object):
+    def setUp(self):
+        super().setUp()
+        self.handler = MessageHandler()
+        self.controller = Controller(self.handler, hostname='127.0.0.1', port=get_unused_port())
+        self.controller.start()
+        settings_override = override_settings(EMAIL_HOST='127.0.0.1', EMAIL_PORT=self.controller.port)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(self.controller.stop)
+
+
+class AsyncConnectionPoolTest(SMTPServerMixin, SimpleTestCase):
+    def test_delivers_messages(self):
+        messages = [
+            EmailMessage(subject='hi', body='hello {0}'.format(i), to=['test{0}@example.com'.format(i)])
+            for i in range(5)
+        ]
+
+        with AsyncConnectionPool(2) as pool:
+            exceptions = pool.deliver_messages(messages)
+
+        self.assertEqual(exceptions, [None] * 5)
+        self.assertEqual(
+            sorted(envelope.rcpt_tos[0] for envelope in self.handler.envelopes),
+            ['test{0}@example.com'.format(i) for i in range(5)],
+        )
+
+    def test_delivery_exceptions_are_isolated(self):
+        messages = [
+            EmailMessage(subject='hi', body='hello', to=['reject@example.com']),
+            EmailMessage(subject='hi', body='hello', to=['test@example.com']),
+        ]
+
+        with AsyncConnectionPool() as pool:
+            exceptions = pool.deliver_messages(messages)
+
+        self.assertIsInstance(exceptions[0], async_delivery.aiosmtplib.SMTPException)
+        self.assertIsNone(exceptions[1])
+        self.assertEqual([envelope.rcpt_tos for envelope in self.handler.envelopes], [['test@example.com']])
+
+    def test_connection_errors(self):
+        with AsyncConnectionPool(port=get_unused_port()) as pool:
+            exceptions = pool.deliver_messages([EmailMessage(subject='hi', body='hello', to=['test@example.com'])])
+
+        self.assertIsInstance(exceptions[0], OSError)
+
+    def test_close_after_failed_quit(self):
+        with AsyncConnectionPool() as pool:
+            pool.deliver_messages([EmailMessage(subject='hi', body='hello', to=['test@example.com'])])
+            with patch.object(
+                pool.clients[0], 'quit', side_effect=async_delivery.aiosmtplib.SMTPException('quit failed')
+            ):
+                pool.loop.run_until_complete(pool.close())
+
+            self.assertFalse(pool.clients[0].is_connected)
+
+    def test_requires_aiosmtplib(self):
+        with patch.object(async_delivery, 'aiosmtplib', None):
+            with self.assertRaises(ImproperlyConfigured):
+                AsyncConnectionPool()
+
+
+class SendUnsentScheduledEmailsAsyncTest(SMTPServerMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        G(Medium, name='email')
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True, ENTITY_EMAILER_ASYNC_DELIVERY=True)
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_sends_with_async_delivery(self, render_mock, address_mock):
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.side_effect = lambda email: ['test{0}@example.com'.format(email.id)]
+        emails = [g_email(context={}, scheduled=datetime.min) for _ in range(3)]
+
+        EntityEmailerInterface.send_unsent_scheduled_emails(batch_size=2, num_workers=2)
+
+        self.assertEqual(
+            sorted(envelope.rcpt_tos[0] for envelope in self.handler.envelopes),
+            sorted('test{0}@example.com'.format(email.id) for email in emails),
+        )
+        self.assertEqual(3, Email.objects.filter(sent__isnull=False).count())
+
+    @override_settings(DISABLE_DURABILITY_CHECKING=True)
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_saves_async_delivery_failures(self, render_mock, address_mock):
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.side_effect = [['reject@example.com'], ['test@example.com']]
+        failed_email = g_email(context={}, scheduled=datetime.min)
+        sent_email = g_email(context={}, scheduled=datetime.min)
+
+        EntityEmailerInterface.send_unsent_scheduled_emails(use_async=True)
+
+        failed_email.refresh_from_db()
+        sent_email.refresh_from_db()
+        self.assertIsNone(failed_email.sent)
+        self.assertEqual(failed_email.num_tries, 1)
+        self.assertIn('554', failed_email.exception)
+        self.assertIsNotNone(sent_email.sent)
+        self.assertEqual(1, len(self.handler.envelopes))
+
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_run_entity_emailer_with_async_delivery(self, render_mock, address_mock):
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.return_value = ['test@example.com']
+        email = g_email(context={}, scheduled=datetime.min)
+        stderr = StringIO()
+
+        call_command('run_entity_emailer', '--async', '--max-polls', '1', stderr=stderr)
+
+        self.assertEqual(stderr.getvalue(), '')
+        self.assertEqual([envelope.rcpt_tos for envelope in self.handler.envelopes], [['test@example.com']])
+        self.assertEqual(list(Email.objects.filter(sent__isnull=False)), [email])
+
+    @patch.object(EntityEmailerInterface, 'send_unsent_scheduled_emails')
+    def test_asend_unsent_scheduled_emails(self, send_mock):
+        send_mock.return_value = 3
+
+        num_emails = asyncio.run(EntityEmailerInterface.asend_unsent_scheduled_emails(batch_size=2, use_async=True))
+
+        self.assertEqual(num_emails, 3)
+        send_mock.assert_called_once_with(2, None, True)
@@ -1,7 +1,23 @@
-from django.core.management import call_command
-from django.test import TestCase
-from entity_event.models import Medium, Source
+from datetime import datetime
+from io import StringIO
+import os
+import signal
+import smtplib
+import threading
+import time
 
+from django.core import mail
+from django.core.management import call_command, CommandError
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django_dynamic_fixture import G
+from entity_event.models import Event, Medium, Source
+from unittest.mock import Mock, patch
+
+from entity_emailer.interface import EntityEmailerInterface
+from entity_emailer.management.commands.run_entity_emailer import Command
+from entity_emailer.models import Email
+from entity_emailer.tests.utils import g_email
 from entity_emailer.utils import get_medium, get_admin_source
 
 
@@ -41,3 +57,126 @@ class EntityEmailerAdminSetupTest(TestCase):
             call_command('entity_emailer_admin_setup')
             source = get_admin_source()
         self.assertEqual(source.name, custom_source_name)
+
+
+class RunEntityEmailerTest(TestCase):
+    def setUp(self):
+        G(Medium, name='email')
+
+    @patch('entity_emailer.interface.get_subscribed_email_addresses')
+    @patch.object(Event, 'render', spec_set=True)
+    def test_sends_due_emails(self, render_mock, address_mock):
+        render_mock.return_value = ['<p>This is a test html email.</p>', 'This is a test text email.']
+        address_mock.return_value = ['test1@example.com']
+        email = g_email(context={}, scheduled=datetime.min)
+        g_email(context={}, scheduled=datetime.max)
+
+        call_command('run_entity_emailer', max_polls=1)
+
+        self.assertEqual(1, len(mail.outbox))
+        self.assertEqual(list(Email.objects.filter(sent__isnull=False)), [email])
+
+    @patch.object(Command, 'wait')
+    @patch.object(EntityEmailerInterface, 'send_due_emails')
+    def test_adaptive_backoff(self, send_mock, wait_mock):
+        send_mock.side_effect = [0, 0, 0, 5, 0]
+
+        call_command('run_entity_emailer', max_polls=5, min_interval=1, max_interval=4)
+
+        self.assertEqual([call[0][0] for call in wait_mock.call_args_list], [2, 4, 4, 1])
+
+        # The rate limits are shared across polls
+        rate_limiters = {call[1]['rate_limiter'] for call in send_mock.call_args_list}
+        self.assertEqual(len(rate_limiters), 1)
+
+    @patch.object(EntityEmailerInterface, 'send_due_emails')
+    def test_stops_on_sigterm(self, send_mock):
+        previous_handler = signal.getsignal(signal.SIGTERM)
+
+        def send_due_emails(email_connections, batch_size, should_stop, rate_limiter):
+            self.assertFalse(should_stop())
+            os.kill(os.getpid(), signal.SIGTERM)
+            self.assertTrue(should_stop())
+            return 1
+
+        send_mock.side_effect = send_due_emails
+
+        call_command('run_entity_emailer')
+
+        self.assertEqual(send_mock.call_count, 1)
+        self.assertEqual(signal.getsignal(signal.SIGTERM), previous_handler)
+
+    @patch.object(EntityEmailerInterface, 'send_due_emails')
+    def test_reports_errors(self, send_mock):
+        send_mock.side_effect = Exception('send failed')
+        stderr = StringIO()
+
+        call_command('run_entity_emailer', max_polls=1, stderr=stderr)
+
+        self.assertIn('send failed', stderr.getvalue())
+
+    @patch.object(EntityEmailerInterface, 'send_due_emails')
+    def test_closes_broken_database_connections(self, send_mock):
+        send_mock.side_effect = Exception('connection lost')
+
+        with patch.object(connection, 'is_usable', return_value=False), \
+                patch.object(connection, 'close') as close_mock:
+            call_command('run_entity_emailer', max_polls=1, stderr=StringIO())
+
+        close_mock.assert_called_once_with()
+
+    def test_refreshes_closed_smtp_connections(self):
+        open_connection = Mock(connection=Mock(noop=Mock(return_value=(250, b'OK'))))
+        closed_connection = Mock(connection=Mock(noop=Mock(side_effect=smtplib.SMTPServerDisconnected())))
+        unhealthy_connection = Mock(connection=Mock(noop=Mock(return_value=(421, b'Closing'))))
+        locmem_connection = Mock(connection=None)
+
+        Command().refresh_connections([open_connection, closed_connection, unhealthy_connection, locmem_connection])
+
+        self.assertFalse(open_connection.open.called)
+        closed_connection.close.assert_called_once_with()
+        closed_connection.open.assert_called_once_with()
+        unhealthy_connection.open.assert_called_once_with()
+
+    @patch.object(connection, 'vendor', 'sqlite')
+    def test_listen_requires_postgresql(self):
+        with self.assertRaises(CommandError):
+            call_command('run_entity_emailer', listen=True)
+
+
+class RunEntityEmailerListenTest(TransactionTestCase):
+    def test_wakes_on_inserted_emails(self):
+        if connection.vendor != 'postgresql':  # pragma: no cover
+            self.skipTest('Listening for notifications is only supported on PostgreSQL')
+
+        command = Command()
+        command.stopping = threading.Event()
+        command.listen()
+
+        self.assertFalse(command.wait_for_notification(0))
+        g_email(context={})
+
+        start = time.monotonic()
+        command.wait(30, listen=True)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_waits_for_interval(self):
+        if connection.vendor != 'postgresql':  # pragma: no cover
+            self.skipTest('Listening for notifications is only supported on PostgreSQL')
+
+        command = Command()
+        command.stopping = threading.Event()
+
+        start = time.monotonic()
+        command.wait(0.1, listen=True)
+        command.wait(0.1, listen=False)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_stop_interrupts_wait(self):
+        command = Command()
+        command.stopping = threading.Event()
+        threading.Timer(0.1, command.stopping.set).start()
+
+        start = time.monotonic()
+        command.wait(30, listen=False)
+        self.assertLess(time.monotonic() - start, 5)
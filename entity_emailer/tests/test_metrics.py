@@ -0,0 +1,27 @@
+from django.test import SimpleTestCase
+
+from entity_emailer.metrics import SendMetrics
+
+
+class SendMetricsTest(SimpleTestCase):
+    def test_enabled(self):
+        metrics = SendMetrics(enabled=True)
+        with metrics.timer('render'):
+            pass
+        with metrics.timer('render'):
+            pass
+        metrics.incr('sent')
+        metrics.incr('sent', 2)
+
+        self.assertEqual(set(metrics.as_dict()['timings']), {'render'})
+        self.assertGreaterEqual(metrics.as_dict()['timings']['render'], 0)
+        self.assertEqual(metrics.as_dict()['counts'], {'sent': 3})
+
+    def test_disabled(self):
+        metrics = SendMetrics()
+        with metrics.timer('render'):
+            pass
+        metrics.incr('sent')
+
+        self.assertIs(metrics.timer('render'), SendMetrics.null_timer)
+        self.assertEqual(metrics.as_dict(), {'timings': {}, 'counts': {}})
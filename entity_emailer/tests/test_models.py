@@ -1,12 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import json
+import pickle
 
-from django.test import TestCase
+from django.db import connection
+from django.db.models.signals import m2m_changed
+from django.template import Context, Template
+from django.test import SimpleTestCase, TestCase
 from django_dynamic_fixture import G
 from entity.models import Entity
-from entity_event.models import Event
+from entity_event import context_loader
+from entity_event.models import ContextRenderer, Event, Medium, RenderingStyle, Source
 from freezegun import freeze_time
+from unittest.mock import patch
 
-from entity_emailer.models import Email
+from entity_emailer.models import ContextOverlay, Email
+from entity_emailer.tests.utils import g_email
 
 
 class EmailManagerCreateEmailTest(TestCase):
@@ -51,3 +60,263 @@ class EmailManagerCreateEmailTest(TestCase):
         self.assertEqual(e.from_address, 'hi@hi.com')
         self.assertEqual(e.event.context, {'hi': 'hi'})
         self.assertIsNone(e.uid)
+
+    def test_w_recipient_ids(self):
+        e1 = G(Entity)
+        e2 = G(Entity)
+        event = G(Event, context={'hi': 'hi'})
+        e = Email.objects.create_email(
+            recipients=[e1], recipient_ids=[e1.id, e2.id], subject='hi', from_address='hi@hi.com', event=event)
+        self.assertEqual(set(e.recipients.all()), set([e1, e2]))
+
+    def test_w_recipient_primary_keys(self):
+        e1 = G(Entity)
+        e2 = G(Entity)
+        event = G(Event, context={'hi': 'hi'})
+        e = Email.objects.create_email(recipients=[e1, e2.pk], subject='hi', from_address='hi@hi.com', event=event)
+        self.assertEqual(set(e.recipients.all()), set([e1, e2]))
+
+    def test_minimum_number_of_queries(self):
+        e1 = G(Entity)
+        e2 = G(Entity)
+        event = G(Event, context={'hi': 'hi'})
+
+        # Besides the savepoint queries, one query inserts the email and one inserts its recipients
+        with self.assertNumQueries(4):
+            e = Email.objects.create_email(
+                recipients=[e1, e2], subject='hi', from_address='hi@hi.com', event=event)
+
+        self.assertEqual(set(e.recipients.all()), set([e1, e2]))
+
+    def test_sends_m2m_changed(self):
+        e1 = G(Entity)
+        event = G(Event, context={'hi': 'hi'})
+        received = []
+
+        def receiver(sender, instance, action, pk_set, **kwargs):
+            received.append((sender, action, pk_set, set(instance.recipients.all())))
+
+        m2m_changed.connect(receiver, sender=Email.recipients.through)
+        self.addCleanup(m2m_changed.disconnect, receiver, sender=Email.recipients.through)
+
+        Email.objects.create_email(subject='hi', event=event)
+        self.assertEqual(received, [])
+
+        Email.objects.create_email(recipients=[e1], subject='hi', from_address='hi@hi.com', event=event)
+        self.assertEqual(received, [
+            (Email.recipients.through, 'pre_add', {e1.id}, set()),
+            (Email.recipients.through, 'post_add', {e1.id}, {e1}),
+        ])
+
+
+class EmailManagerCreateEmailsTest(TestCase):
+    @freeze_time('2013-2-3')
+    def test_recipients_and_recipient_ids(self):
+        e1 = G(Entity)
+        e2 = G(Entity)
+        e3 = G(Entity)
+        event = G(Event, context={'hi': 'hi'})
+
+        emails = Email.objects.create_emails([
+            dict(event=event, from_address='hi@hi.com', recipients=[e1, e2, e1]),
+            dict(event=event, from_address='hi@hi.com', recipient_ids=(e3.id, e2.id, e3.id), recipients=[e2]),
+            dict(event=event, from_address='hi@hi.com', scheduled=datetime(2013, 4, 5)),
+        ])
+
+        self.assertEqual(set(emails[0].recipients.all()), {e1, e2})
+        self.assertEqual(set(emails[1].recipients.all()), {e2, e3})
+        self.assertEqual(list(emails[2].recipients.all()), [])
+        self.assertEqual([email.scheduled for email in emails], [
+            datetime(2013, 2, 3), datetime(2013, 2, 3), datetime(2013, 4, 5)
+        ])
+
+    def test_batch_size(self):
+        entities = [G(Entity) for i in range(3)]
+        event = G(Event, context={'hi': 'hi'})
+
+        # Besides the savepoint queries, one query inserts the emails and two insert the recipients
+        with self.assertNumQueries(5):
+            email = Email.objects.create_emails([
+                dict(event=event, from_address='hi@hi.com', recipient_ids=[entity.id for entity in entities]),
+            ], batch_size=2)[0]
+
+        self.assertEqual(set(email.recipients.all()), set(entities))
+
+    def test_create_email_recipients_ignores_existing(self):
+        e1 = G(Entity)
+        e2 = G(Entity)
+        email = Email.objects.create_emails([dict(event=G(Event, context={}), recipient_ids=[e1.id])])[0]
+
+        Email.objects.create_email_recipients([(email.id, e1.id), (email.id, e2.id)])
+
+        self.assertEqual(set(email.recipients.all()), {e1, e2})
+
+
+class EmailRenderTest(TestCase):
+    def setUp(self):
+        rendering_style = G(RenderingStyle)
+        self.medium = G(Medium, rendering_style=rendering_style, additional_context={})
+        source = G(Source)
+        G(
+            ContextRenderer, source=source, rendering_style=rendering_style,
+            text_template='Hi {{ name }} {{ entity_emailer_id }}', html_template='<b>{{ entity_emailer_id }}</b>',
+        )
+        self.event = G(Event, source=source, context={'name': 'Swansonbot'})
+
+    def test_render(self):
+        email = g_email(event=self.event)
+        context_loader.load_contexts_and_renderers([email.event], [self.medium])
+
+        self.assertEqual(
+            email.render(self.medium),
+            ('Hi Swansonbot {0}'.format(email.view_uid), '<b>{0}</b>'.format(email.view_uid))
+        )
+        self.assertEqual(email.event.context, {'name': 'Swansonbot'})
+
+    def test_render_once_per_event(self):
+        emails = [g_email(event=self.event) for _ in range(3)]
+        for email in emails:
+            email.event = self.event
+        context_loader.load_contexts_and_renderers([self.event], [self.medium])
+        rendered_events = {}
+
+        with patch.object(Event, 'render', autospec=True, side_effect=Event.render) as render_mock:
+            rendered = [email.render(self.medium, rendered_events) for email in emails]
+
+        # The second email is rendered to verify that the first rendering may be shared
+        self.assertEqual(render_mock.call_count, 2)
+        self.assertEqual(rendered, [
+            ('Hi Swansonbot {0}'.format(email.view_uid), '<b>{0}</b>'.format(email.view_uid))
+            for email in emails
+        ])
+        self.assertEqual(self.event.context, {'name': 'Swansonbot'})
+
+    def test_render_once_per_event_with_transformed_id(self):
+        """
+        Verifies that every email of an event is rendered on its own when its template transforms the id
+        """
+        G(
+            ContextRenderer, source=self.event.source, rendering_style=G(RenderingStyle),
+            text_template='{{ entity_emailer_id|upper }}', html_template='{{ entity_emailer_id|cut:"-" }}',
+        )
+        medium = G(Medium, rendering_style=ContextRenderer.objects.last().rendering_style, additional_context={})
+        emails = [g_email(event=self.event) for _ in range(3)]
+        for email in emails:
+            email.event = self.event
+        context_loader.load_contexts_and_renderers([self.event], [medium])
+        rendered_events = {}
+
+        with patch.object(Event, 'render', autospec=True, side_effect=Event.render) as render_mock:
+            rendered = [email.render(medium, rendered_events) for email in emails]
+
+        self.assertEqual(render_mock.call_count, 3)
+        self.assertEqual(rendered, [
+            (str(email.view_uid).upper(), str(email.view_uid).replace('-', ''))
+            for email in emails
+        ])
+
+    def test_render_concurrently(self):
+        """
+        Verifies that the emails of one loaded event may be rendered from several threads at once
+        """
+        emails = [g_email(event=self.event) for _ in range(20)]
+        for email in emails:
+            email.event = self.event
+        context_loader.load_contexts_and_renderers([self.event], [self.medium])
+
+        with ThreadPoolExecutor(4) as executor:
+            rendered = list(executor.map(lambda email: email.render(self.medium), emails))
+
+        self.assertEqual(rendered, [
+            ('Hi Swansonbot {0}'.format(email.view_uid), '<b>{0}</b>'.format(email.view_uid))
+            for email in emails
+        ])
+        self.assertEqual(self.event.context, {'name': 'Swansonbot'})
+
+    def test_render_with_template_path_and_additional_context(self):
+        self.medium.additional_context = {'greeting': 'Hello'}
+        G(
+            ContextRenderer, source=G(Source), rendering_style=self.medium.rendering_style,
+            html_template_path='hi_template.html', text_template='{{ greeting }} {{ entity_emailer_id }}',
+        )
+        email = g_email(event=G(Event, source=ContextRenderer.objects.last().source, context={'entity': 'Ron'}))
+        context_loader.load_contexts_and_renderers([email.event], [self.medium])
+
+        self.assertEqual(email.render(self.medium), ('Hello {0}'.format(email.view_uid), '<html>Hi Ron</html>'))
+        self.assertEqual(email.event.context, {'entity': 'Ron'})
+
+
+class ContextOverlayTest(SimpleTestCase):
+    def test_reads_through_to_context(self):
+        context = {'name': 'Swansonbot', 'entity_emailer_id': 'shared'}
+        overlay = ContextOverlay({'entity_emailer_id': '1'}, context)
+
+        self.assertIsInstance(overlay, dict)
+        self.assertEqual(overlay['name'], 'Swansonbot')
+        self.assertEqual(overlay['entity_emailer_id'], '1')
+        self.assertIn('name', overlay)
+        self.assertIsNone(overlay.get('missing'))
+        self.assertEqual(dict(overlay), {'name': 'Swansonbot', 'entity_emailer_id': '1'})
+        self.assertEqual(overlay, {'name': 'Swansonbot', 'entity_emailer_id': '1'})
+        self.assertEqual(Template('{{ name }} {{ entity_emailer_id }}').render(Context(overlay)), 'Swansonbot 1')
+
+    def test_writes_to_overrides(self):
+        context = {'name': 'Swansonbot'}
+        overlay = ContextOverlay({}, context)
+        overlay['name'] = 'Tammy'
+        overlay_copy = overlay.copy()
+        overlay_copy['name'] = 'Ron'
+
+        self.assertEqual(overlay['name'], 'Tammy')
+        self.assertEqual(overlay_copy['name'], 'Ron')
+        self.assertIsInstance(overlay_copy, ContextOverlay)
+        self.assertIs(overlay_copy.maps[1], context)
+        self.assertEqual(context, {'name': 'Swansonbot'})
+
+    def test_chain_map_methods(self):
+        overlay = ContextOverlay({'entity_emailer_id': '1'}, {'name': 'Swansonbot'})
+        child = overlay.new_child({'name': 'Ron'})
+
+        self.assertIsInstance(child, ContextOverlay)
+        self.assertEqual(child['name'], 'Ron')
+        self.assertEqual(child['entity_emailer_id'], '1')
+        self.assertEqual(child.parents, overlay)
+        self.assertEqual(overlay.parents, {'name': 'Swansonbot'})
+
+    def test_pickle(self):
+        overlay = ContextOverlay({'entity_emailer_id': '1'}, {'name': 'Swansonbot'})
+        unpickled = pickle.loads(pickle.dumps(overlay))
+
+        self.assertIsInstance(unpickled, ContextOverlay)
+        self.assertEqual(unpickled.maps, [{'entity_emailer_id': '1'}, {'name': 'Swansonbot'}])
+        self.assertEqual(json.dumps(dict(unpickled)), '{"name": "Swansonbot", "entity_emailer_id": "1"}')
+
+
+class EmailDueIndexTest(TestCase):
+    def test_due_emails_query_uses_index(self):
+        """
+        Verifies that the query for the emails that are due to be sent is planned on the due index
+        """
+        if connection.vendor != 'postgresql':  # pragma: no cover
+            self.skipTest('Query plans are only checked on PostgreSQL')
+
+        email = g_email(context={}, scheduled=datetime.min)
+        g_email(context={}, scheduled=datetime.min, sent=datetime.min)
+        g_email(context={}, scheduled=datetime.max)
+
+        due_emails = Email.objects.filter(
+            scheduled__lte=datetime(2013, 1, 1),
+            sent__isnull=True,
+            num_tries__lt=3
+        ).order_by(
+            'scheduled',
+            'id'
+        )
+
+        # Keep the planner from choosing a sequential scan of the tiny test table
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            plan = due_emails.explain()
+
+        self.assertIn('entity_emailer_email_due', plan)
+        self.assertEqual(list(due_emails), [email])
@@ -0,0 +1,105 @@
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+from unittest.mock import patch
+
+from entity_emailer.rate_limit import RateLimiter, TokenBucket
+
+
+@patch('entity_emailer.rate_limit.time.monotonic', return_value=100)
+class TokenBucketTest(SimpleTestCase):
+    def test_starts_full(self, monotonic_mock):
+        bucket = TokenBucket(2)
+
+        self.assertEqual(bucket.get_delay(2, 100), 0)
+        bucket.take(2)
+        self.assertEqual(bucket.get_delay(1, 100), 0.5)
+
+    def test_refills_up_to_capacity(self, monotonic_mock):
+        bucket = TokenBucket(2, capacity=4)
+        bucket.take(4)
+
+        self.assertEqual(bucket.get_delay(2, 101), 0)
+        self.assertEqual(bucket.get_delay(4, 110), 0)
+        self.assertEqual(bucket.tokens, 4)
+
+    def test_requests_larger_than_capacity(self, monotonic_mock):
+        bucket = TokenBucket(0.5)
+        self.assertEqual(bucket.capacity, 1)
+
+        self.assertEqual(bucket.get_delay(5, 100), 0)
+        bucket.take(5)
+        self.assertEqual(bucket.get_delay(5, 100), 10)
+
+
+@patch('entity_emailer.rate_limit.time.monotonic', return_value=100)
+class RateLimiterTest(SimpleTestCase):
+    def test_disabled(self, monotonic_mock):
+        rate_limiter = RateLimiter()
+
+        self.assertFalse(rate_limiter.enabled)
+        for _ in range(100):
+            self.assertEqual(rate_limiter.acquire(['test@example.com']), 0)
+
+    def test_global_rate(self, monotonic_mock):
+        rate_limiter = RateLimiter(rate=2)
+
+        self.assertEqual(rate_limiter.acquire(['test1@example.com', 'test2@example.com']), 0)
+        self.assertEqual(rate_limiter.acquire(['test1@example.com']), 0)
+        self.assertEqual(rate_limiter.acquire(['test1@example.com']), 0.5)
+
+        monotonic_mock.return_value = 100.5
+        self.assertEqual(rate_limiter.acquire(['test1@example.com']), 0)
+
+    def test_domain_rates(self, monotonic_mock):
+        rate_limiter = RateLimiter(domain_rates={'Example.com': 2}, default_domain_rate=1)
+
+        self.assertEqual(rate_limiter.acquire(['test1@example.com', 'Test <test2@EXAMPLE.com>']), 0)
+        self.assertEqual(rate_limiter.acquire(['test3@example.com']), 0.5)
+        self.assertEqual(rate_limiter.acquire(['test1@other.com']), 0)
+        self.assertEqual(rate_limiter.acquire(['test2@other.com']), 1)
+
+    def test_unlimited_domains(self, monotonic_mock):
+        rate_limiter = RateLimiter(domain_rates={'example.com': 1})
+
+        self.assertEqual(rate_limiter.acquire(['test1@example.com']), 0)
+        for _ in range(10):
+            self.assertEqual(rate_limiter.acquire(['test1@other.com']), 0)
+
+    def test_takes_no_tokens_when_throttled(self, monotonic_mock):
+        rate_limiter = RateLimiter(rate=2, domain_rates={'example.com': 1})
+
+        self.assertEqual(rate_limiter.acquire(['test1@example.com']), 0)
+        self.assertEqual(rate_limiter.acquire(['test2@example.com']), 1)
+        self.assertEqual(rate_limiter.acquire(['test1@other.com']), 0)
+
+    def test_spreads_deferred_messages(self, monotonic_mock):
+        rate_limiter = RateLimiter(domain_rates={'example.com': 2})
+
+        self.assertEqual(rate_limiter.acquire(['test1@example.com', 'test2@example.com']), 0)
+        self.assertEqual(
+            [rate_limiter.acquire(['test{0}@example.com'.format(i)]) for i in range(3)],
+            [0.5, 1, 1.5]
+        )
+
+    def test_is_exhausted(self, monotonic_mock):
+        self.assertFalse(RateLimiter(domain_rates={'example.com': 1}).is_exhausted())
+
+        rate_limiter = RateLimiter(rate=1)
+        self.assertFalse(rate_limiter.is_exhausted())
+        rate_limiter.acquire(['test@example.com'])
+        self.assertTrue(rate_limiter.is_exhausted())
+
+        monotonic_mock.return_value = 101
+        self.assertFalse(rate_limiter.is_exhausted())
+
+    @override_settings(
+        ENTITY_EMAILER_RATE_LIMIT=10,
+        ENTITY_EMAILER_DOMAIN_RATE_LIMITS={'example.com': 5},
+        ENTITY_EMAILER_DEFAULT_DOMAIN_RATE_LIMIT=1,
+    )
+    def test_from_settings(self, monotonic_mock):
+        rate_limiter = RateLimiter.from_settings()
+
+        self.assertEqual(rate_limiter.rate, 10)
+        self.assertEqual(rate_limiter.domain_rates, {'example.com': 5})
+        self.assertEqual(rate_limiter.default_domain_rate, 1)
@@ -1,8 +1,13 @@
+import hashlib
+
+from django.core.cache import cache
 from django.urls import reverse
 from django.test import TestCase
+from django.test.utils import override_settings
 from django_dynamic_fixture import G
 from entity.models import Entity
 from entity_event.models import Medium, RenderingStyle, ContextRenderer, Source, Event
+from freezegun import freeze_time
 
 from entity_emailer.tests.utils import g_email
 
@@ -13,6 +18,22 @@ class EmailViewTest(TestCase):
         G(Medium, name='email', rendering_style=self.rendering_style)
         self.source = G(Source)
 
+    def tearDown(self):
+        cache.clear()
+
+    def g_html_email(self):
+        G(
+            ContextRenderer, source=self.source, html_template_path='hi_template.html',
+            rendering_style=self.rendering_style, context_hints={
+                'entity': {
+                    'app_name': 'entity',
+                    'model_name': 'Entity',
+                }
+            })
+        person = G(Entity, display_name='Swansonbot')
+        event = G(Event, context={'entity': person.id}, source=self.source)
+        return g_email(event=event)
+
     def test_html_path(self):
         G(
             ContextRenderer, source=self.source, html_template_path='hi_template.html',
@@ -73,3 +94,87 @@ class EmailViewTest(TestCase):
         content = content.decode('utf8')
 
         self.assertEqual(content, '<html>Hi Swansonbot</html>')
+
+    def test_fixed_number_of_queries(self):
+        """
+        Verifies that the email, its event and source, and its context are fetched in a fixed number of queries
+        """
+        G(
+            ContextRenderer, source=self.source, html_template_path='hi_template.html',
+            rendering_style=self.rendering_style, context_hints={
+                'entity': {
+                    'app_name': 'entity',
+                    'model_name': 'Entity',
+                }
+            })
+        person = G(Entity, display_name='Swansonbot')
+        event = G(Event, context={'entity': person.id}, source=self.source)
+        email = g_email(event=event)
+        url = reverse('entity_emailer.email', args=[email.view_uid])
+
+        with self.assertNumQueries(5):
+            response = self.client.get(url)
+
+        self.assertEqual(response.content.decode('utf8'), '<html>Hi Swansonbot</html>')
+
+    def test_conditional_headers(self):
+        email = self.g_html_email()
+        url = reverse('entity_emailer.email', args=[email.view_uid])
+
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Last-Modified', response)
+        self.assertEqual(
+            response['ETag'],
+            '"{0}"'.format(hashlib.sha1('<html>Hi Swansonbot</html>'.encode('utf-8')).hexdigest())
+        )
+
+    def test_if_modified_since_is_ignored(self):
+        """
+        Verifies that the email is rendered again for a request with only If-Modified-Since, since the rendering
+        may change without the email or its event being modified
+        """
+        email = self.g_html_email()
+        url = reverse('entity_emailer.email', args=[email.view_uid])
+
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE='Wed, 01 Jan 2030 00:00:00 GMT')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.decode('utf8'), '<html>Hi Swansonbot</html>')
+
+    def test_if_none_match(self):
+        email = self.g_html_email()
+        url = reverse('entity_emailer.email', args=[email.view_uid])
+        etag = self.client.get(url)['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+    @override_settings(ENTITY_EMAILER_VIEW_CACHE_TIMEOUT=60)
+    def test_cached(self):
+        with freeze_time('2014-01-05'):
+            email = self.g_html_email()
+            url = reverse('entity_emailer.email', args=[email.view_uid])
+            first_response = self.client.get(url)
+
+        # The cached rendering is served without touching the database
+        with freeze_time('2014-01-05 00:00:30'), self.assertNumQueries(0):
+            response = self.client.get(url)
+
+        self.assertEqual(response.content.decode('utf8'), '<html>Hi Swansonbot</html>')
+        self.assertEqual(response['ETag'], first_response['ETag'])
+
+    @override_settings(ENTITY_EMAILER_VIEW_CACHE_TIMEOUT=60)
+    def test_cached_if_none_match(self):
+        email = self.g_html_email()
+        url = reverse('entity_emailer.email', args=[email.view_uid])
+        etag = self.client.get(url)['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
@@ -1,8 +1,12 @@
-from django.test import TestCase
+from django.core.mail import EmailMultiAlternatives
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import override_settings
 from django_dynamic_fixture import G
 from entity_event.models import Medium, Source
+from unittest.mock import patch
 
-from entity_emailer.utils import get_medium, get_admin_source
+from entity_emailer.utils import get_medium, get_admin_source, get_emailer_settings, get_retry_delay, \
+    get_content_size
 
 
 class GetMediumTest(TestCase):
@@ -19,6 +23,31 @@ class GetMediumTest(TestCase):
             medium = get_medium()
         self.assertEqual(medium.name, custom_medium_name)
 
+    def test_get_medium_cached(self):
+        G(Medium, name='email')
+        medium = get_medium()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_medium(), medium)
+
+    def test_get_medium_does_not_share_unsubscriptions(self):
+        G(Medium, name='email')
+        get_medium().unsubscriptions
+        with self.assertNumQueries(0):
+            self.assertNotIn('unsubscriptions', get_medium().__dict__)
+
+    def test_get_medium_cache_cleared_on_save(self):
+        medium = G(Medium, name='email')
+        get_medium()
+        medium.display_name = 'Email'
+        medium.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(get_medium().display_name, 'Email')
+
+    def test_get_medium_cache_cleared_on_delete(self):
+        G(Medium, name='email').delete()
+        G(Medium, name='email')
+        self.assertEqual(get_medium(), Medium.objects.get(name='email'))
+
 
 class GetAdminSourceTest(TestCase):
     def test_get_admin_source_default(self):
@@ -33,3 +62,50 @@ class GetAdminSourceTest(TestCase):
         with self.settings(ENTITY_EMAILER_ADMIN_SOURCE_NAME=custom_admin_source_name):
             admin_source = get_admin_source()
         self.assertEqual(admin_source.name, custom_admin_source_name)
+
+    def test_get_admin_source_cached(self):
+        G(Source, name='admin')
+        admin_source = get_admin_source()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_admin_source(), admin_source)
+
+
+class GetEmailerSettingsTest(TestCase):
+    def test_settings_cleared_on_setting_changed(self):
+        self.assertEqual(get_emailer_settings()['email_key'], 'email')
+        with self.settings(ENTITY_EMAILER_EMAIL_KEY='email_address'):
+            self.assertEqual(get_emailer_settings()['email_key'], 'email_address')
+        self.assertEqual(get_emailer_settings()['email_key'], 'email')
+
+
+class GetRetryDelayTest(TestCase):
+    def test_no_base_delay(self):
+        self.assertEqual(get_retry_delay(1), 0)
+        self.assertEqual(get_retry_delay(5), 0)
+
+    @override_settings(ENTITY_EMAILER_RETRY_BASE_DELAY=10, ENTITY_EMAILER_RETRY_JITTER=0)
+    def test_exponential(self):
+        self.assertEqual([get_retry_delay(num_tries) for num_tries in range(1, 5)], [10, 20, 40, 80])
+
+    @override_settings(
+        ENTITY_EMAILER_RETRY_BASE_DELAY=10, ENTITY_EMAILER_RETRY_MULTIPLIER=3, ENTITY_EMAILER_RETRY_MAX_DELAY=50,
+        ENTITY_EMAILER_RETRY_JITTER=0,
+    )
+    def test_multiplier_and_max_delay(self):
+        self.assertEqual([get_retry_delay(num_tries) for num_tries in range(1, 4)], [10, 30, 50])
+
+    @override_settings(ENTITY_EMAILER_RETRY_BASE_DELAY=10, ENTITY_EMAILER_RETRY_JITTER=0.5)
+    @patch('entity_emailer.utils.random.uniform', return_value=-0.25)
+    def test_jitter(self, uniform_mock):
+        self.assertEqual(get_retry_delay(2), 15)
+        uniform_mock.assert_called_once_with(-0.5, 0.5)
+
+
+class GetContentSizeTest(SimpleTestCase):
+    def test_counts_body_alternatives_and_attachments(self):
+        message = EmailMultiAlternatives('hi', 'text \u2713', 'from@example.com', ['to@example.com'])
+        message.attach_alternative('<p>html</p>', 'text/html')
+        message.attach('report.csv', 'a,b', 'text/csv')
+        message.attach('image.png', b'\x89PNG', 'image/png')
+
+        self.assertEqual(get_content_size(message), len('text ') + 3 + len('<p>html</p>') + len('a,b') + 4)
@@ -1,32 +1,74 @@
-from bs4 import BeautifulSoup
+import copy
+from html.parser import HTMLParser
+import random
+
 from django.conf import settings
 from django.core import mail
+from django.db.models import Value
+from django.db.models.fields.json import KeyTransform
+from entity.models import Entity
 from entity_event.models import Medium, Source
 
+from entity_emailer.models import Email
+
 
 constants = {
     'default_medium_name': 'email',
     'default_admin_source_name': 'admin',
 }
 
+# A process level cache of the emailer settings and of the medium and admin source objects. It is
+# cleared by clear_cache whenever a medium or source is saved or deleted, or a setting is changed.
+_cache = {}
+
+
+def clear_cache(**kwargs):
+    """Clear the cached emailer settings, medium and admin source. Connected as a signal receiver.
+    """
+    _cache.clear()
+
+
+def get_emailer_settings():
+    """Get a dict of the emailer settings, resolved with their defaults.
+    """
+    emailer_settings = _cache.get('settings')
+    if emailer_settings is None:
+        emailer_settings = _cache['settings'] = {
+            'medium_name': getattr(settings, 'ENTITY_EMAILER_MEDIUM_NAME', constants['default_medium_name']),
+            'admin_source_name': getattr(
+                settings, 'ENTITY_EMAILER_ADMIN_SOURCE_NAME', constants['default_admin_source_name']
+            ),
+            'from_email': getattr(settings, 'ENTITY_EMAILER_FROM_EMAIL', settings.DEFAULT_FROM_EMAIL),
+            'email_key': getattr(settings, 'ENTITY_EMAILER_EMAIL_KEY', 'email'),
+            'exclude_key': getattr(settings, 'ENTITY_EMAILER_EXCLUDE_KEY', None),
+            'view_cache_timeout': getattr(settings, 'ENTITY_EMAILER_VIEW_CACHE_TIMEOUT', None),
+            'view_cache_alias': getattr(settings, 'ENTITY_EMAILER_VIEW_CACHE_ALIAS', 'default'),
+            'retry_base_delay': getattr(settings, 'ENTITY_EMAILER_RETRY_BASE_DELAY', None),
+            'retry_multiplier': getattr(settings, 'ENTITY_EMAILER_RETRY_MULTIPLIER', 2),
+            'retry_jitter': getattr(settings, 'ENTITY_EMAILER_RETRY_JITTER', 0.1),
+            'retry_max_delay': getattr(settings, 'ENTITY_EMAILER_RETRY_MAX_DELAY', 3600),
+        }
+    return emailer_settings
+
 
 def get_medium():
     """Get the medium object that the emailer associates with itself.
+
+    A copy of the cached medium is returned, since the medium caches the unsubscriptions that it loads on
+    itself, and they must be loaded again by each caller to see new unsubscriptions.
     """
-    email_medium_name = getattr(
-        settings, 'ENTITY_EMAILER_MEDIUM_NAME', constants['default_medium_name']
-    )
-    email_medium = Medium.objects.get(name=email_medium_name)
-    return email_medium
+    email_medium = _cache.get('medium')
+    if email_medium is None:
+        email_medium = _cache['medium'] = Medium.objects.get(name=get_emailer_settings()['medium_name'])
+    return copy.copy(email_medium)
 
 
 def get_admin_source():
     """Get the source object for emails sent from the admin site.
     """
-    admin_source_name = getattr(
-        settings, 'ENTITY_EMAILER_ADMIN_SOURCE_NAME', constants['default_admin_source_name']
-    )
-    admin_source = Source.objects.get(name=admin_source_name)
+    admin_source = _cache.get('admin_source')
+    if admin_source is None:
+        admin_source = _cache['admin_source'] = Source.objects.get(name=get_emailer_settings()['admin_source_name'])
     return admin_source
 
 
@@ -34,7 +76,28 @@ def get_from_email_address():
     """
     Get a 'from' address based on the django settings.
     """
-    return getattr(settings, 'ENTITY_EMAILER_FROM_EMAIL', settings.DEFAULT_FROM_EMAIL)
+    return get_emailer_settings()['from_email']
+
+
+def get_retry_delay(num_tries):
+    """
+    Get the number of seconds to wait before retrying an email that has failed num_tries times.
+
+    The delay starts at ENTITY_EMAILER_RETRY_BASE_DELAY seconds and is multiplied by
+    ENTITY_EMAILER_RETRY_MULTIPLIER for each further failure up to ENTITY_EMAILER_RETRY_MAX_DELAY seconds.
+    It is then randomly varied by up to the ENTITY_EMAILER_RETRY_JITTER fraction of itself so that the
+    retries of emails that failed together are spread out. Without a base delay failed emails are retried
+    by the next run.
+    """
+    emailer_settings = get_emailer_settings()
+    if not emailer_settings['retry_base_delay']:
+        return 0
+
+    delay = min(
+        emailer_settings['retry_base_delay'] * emailer_settings['retry_multiplier'] ** (num_tries - 1),
+        emailer_settings['retry_max_delay'],
+    )
+    return delay * (1 + random.uniform(-emailer_settings['retry_jitter'], emailer_settings['retry_jitter']))
 
 
 def get_subscribed_email_addresses(email):
@@ -45,13 +108,18 @@ def get_subscribed_email_addresses(email):
 
     If the user wishes to exclude certain entities from receiving emails, they can define
     which field in the entity metadata to use with the EXCLUDE_ENTITY_EMAILER_KEY field.
+
+    If the addresses were resolved ahead of time with prefetch_subscribed_email_addresses they
+    are returned without querying the recipients.
     """
+    if hasattr(email, '_subscribed_email_addresses'):
+        return email._subscribed_email_addresses
 
     # Get the key to use to find the email address
-    email_key = getattr(settings, 'ENTITY_EMAILER_EMAIL_KEY', 'email')
+    email_key = get_emailer_settings()['email_key']
 
     # Get the exclude key
-    exclude_entity_key = getattr(settings, 'ENTITY_EMAILER_EXCLUDE_KEY', None)
+    exclude_entity_key = get_emailer_settings()['exclude_key']
 
     # Get the email addresses from the recipient entities
     email_addresses = []
@@ -69,7 +137,94 @@ def get_subscribed_email_addresses(email):
     return email_addresses
 
 
-def create_email_message(to_emails, from_email, subject, text, html):
+def prefetch_subscribed_email_addresses(emails, entity_email_addresses=None):
+    """
+    Resolves the subscribed email addresses of many emails at once and stores them on the emails
+    so that they are returned by get_subscribed_email_addresses.
+
+    Rather than loading every recipient entity, only the ids of the recipients of the emails and
+    the email and exclude keys of the metadata of recipients that have not been seen yet are fetched.
+
+    :param entity_email_addresses: An optional dict of entity id to the email address of the entity, or
+        None if the entity should not be emailed. It is filled in with the fetched entities and may be
+        shared across calls so that each entity is only fetched once.
+    """
+    if entity_email_addresses is None:
+        entity_email_addresses = {}
+
+    # Get the keys to use to find the email address and to exclude the entity
+    email_key = get_emailer_settings()['email_key']
+    exclude_entity_key = get_emailer_settings()['exclude_key']
+
+    # Get the ids of the recipients of each email
+    recipient_ids_per_email = {email.id: [] for email in emails}
+    recipients = Email.recipients.through.objects.filter(
+        email_id__in=recipient_ids_per_email.keys()
+    ).values_list('email_id', 'entity_id')
+    for email_id, entity_id in recipients:
+        recipient_ids_per_email[email_id].append(entity_id)
+
+    # Fetch the metadata keys of the recipients that have not been seen yet
+    entity_ids_to_fetch = {
+        entity_id
+        for recipient_ids in recipient_ids_per_email.values()
+        for entity_id in recipient_ids
+        if entity_id not in entity_email_addresses
+    }
+    if entity_ids_to_fetch:
+        entities = Entity.objects.filter(id__in=entity_ids_to_fetch).annotate(
+            email_address=KeyTransform(email_key, 'entity_meta'),
+            exclude=KeyTransform(exclude_entity_key, 'entity_meta') if exclude_entity_key else Value(True),
+        ).values_list('id', 'email_address', 'exclude')
+        for entity_id, email_address, exclude in entities:
+            # Make sure the email address exists, is not an empty string and that the entity is not excluded
+            if email_address is not None and len(email_address) and exclude:
+                entity_email_addresses[entity_id] = email_address
+            else:
+                entity_email_addresses[entity_id] = None
+
+        # Inactive entities are not fetched and are never emailed
+        for entity_id in entity_ids_to_fetch:
+            entity_email_addresses.setdefault(entity_id, None)
+
+    for email in emails:
+        email._subscribed_email_addresses = [
+            entity_email_addresses[entity_id]
+            for entity_id in recipient_ids_per_email[email.id]
+            if entity_email_addresses[entity_id]
+        ]
+
+
+class CachedMIMEEmailMultiAlternatives(mail.EmailMultiAlternatives):
+    """
+    An EmailMultiAlternatives that takes the encoded MIME parts of its text alternatives from a cache that may
+    be shared with other messages, so that the same content is only encoded once for all of the messages that
+    differ only in their headers. The cached parts must not be modified, so only the parts of the alternatives
+    are cached, and attachments, which have their headers added to their parts, are always encoded on their own.
+    """
+    def __init__(self, *args, mime_parts=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mime_parts = {} if mime_parts is None else mime_parts
+        self.creating_alternatives = False
+
+    def _create_alternatives(self, msg):
+        self.creating_alternatives = True
+        try:
+            return super()._create_alternatives(msg)
+        finally:
+            self.creating_alternatives = False
+
+    def _create_mime_attachment(self, content, mimetype):
+        if not self.creating_alternatives or not isinstance(content, str) or not mimetype.startswith('text/'):
+            return super()._create_mime_attachment(content, mimetype)
+
+        key = (content, mimetype, self.encoding or settings.DEFAULT_CHARSET)
+        if key not in self.mime_parts:
+            self.mime_parts[key] = super()._create_mime_attachment(content, mimetype)
+        return self.mime_parts[key]
+
+
+def create_email_message(to_emails, from_email, subject, text, html, mime_parts=None):
     """
     Create the appropriate plaintext or html email object.
 
@@ -77,7 +232,9 @@ def create_email_message(to_emails, from_email, subject, text, html):
 
        email - an instance of either `django.core.mail.EmailMessage` or
        `django.core.mail.EmailMulitiAlternatives` based on whether or
-       not `html_message` is empty.
+       not `html_message` is empty. When a dict of mime_parts is given, html
+       emails are a `CachedMIMEEmailMultiAlternatives` that share their
+       encoded html with the other emails of the dict.
     """
     if not html:
         email = mail.EmailMessage(
@@ -87,16 +244,79 @@ def create_email_message(to_emails, from_email, subject, text, html):
             from_email=from_email,
         )
     else:
-        email = mail.EmailMultiAlternatives(
-            subject=subject,
-            body=text,
-            to=to_emails,
-            from_email=from_email,
-        )
+        if mime_parts is None:
+            email = mail.EmailMultiAlternatives(
+                subject=subject,
+                body=text,
+                to=to_emails,
+                from_email=from_email,
+            )
+        else:
+            email = CachedMIMEEmailMultiAlternatives(
+                subject=subject,
+                body=text,
+                to=to_emails,
+                from_email=from_email,
+                mime_parts=mime_parts,
+            )
         email.attach_alternative(html, 'text/html')
     return email
 
 
+def get_content_size(message):
+    """
+    Get the number of bytes of the body, alternatives and attachments of an email message. The size is counted
+    from the content that was handed to the backend rather than by encoding the message as MIME again, so it
+    does not include headers or transfer encoding.
+    """
+    contents = [message.body]
+    contents.extend(content for content, mimetype in getattr(message, 'alternatives', []))
+    contents.extend(attachment[1] for attachment in message.attachments if isinstance(attachment, tuple))
+    return sum(len(content.encode('utf-8')) if isinstance(content, str) else len(content) for content in contents)
+
+
+class TitleParser(HTMLParser):
+    """
+    Collects the text of the first title tag of an html document. Parsing stops as soon as the title
+    has been read or the head of the document has ended, so the body is never parsed.
+    """
+    class Done(Exception):
+        pass
+
+    def __init__(self):
+        super().__init__()
+        self.title = None
+        self.in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'title':
+            self.in_title = True
+            self.title = ''
+        elif tag == 'body':
+            raise TitleParser.Done()
+
+    def handle_endtag(self, tag):
+        if tag in ('title', 'head'):
+            raise TitleParser.Done()
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title += data
+
+
+def extract_html_title(html):
+    """
+    Returns the text of the title tag of the html, or None if the head of the html has no title.
+    """
+    parser = TitleParser()
+    try:
+        parser.feed(html)
+        parser.close()
+    except TitleParser.Done:
+        pass
+    return parser.title
+
+
 def extract_email_subject_from_html_content(email_content):
     """
     This function extracts an email subject from the rendered html email context.
@@ -105,8 +325,8 @@ def extract_email_subject_from_html_content(email_content):
     the first 40 characters of the email are used as the subject. In the latter
     case, it is assumed that html tags are not actually present in the html content.
     """
-    soup = BeautifulSoup(email_content, 'html.parser')
-    subject = soup.title.string.strip() if soup.title else None
+    title = extract_html_title(email_content)
+    subject = title.strip() if title else None
     if not subject:
         subject = email_content.split('\n')[0].strip()[:40]
         if len(subject) == 40:
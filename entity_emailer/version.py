@@ -1 +1 @@
-__version__ = '2.2.0'
+__version__ = '2.3.0'
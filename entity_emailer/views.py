@@ -1,22 +1,70 @@
+import hashlib
+
+from django.core.cache import caches
 from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from django.views.generic import View
 from entity_event import context_loader
 
 from entity_emailer.models import Email
-from entity_emailer.utils import get_medium
+from entity_emailer.utils import get_emailer_settings, get_medium
 
 
 class EmailView(View):
     """
     Provides a basic view for emails that utilizes the html or text templates for rendering.
     Note that it is assumed a url argument of the email view_uid is passed in.
+
+    The rendered email is cached for ENTITY_EMAILER_VIEW_CACHE_TIMEOUT seconds in the cache named by
+    ENTITY_EMAILER_VIEW_CACHE_ALIAS when the timeout is set. Responses carry an ETag of the rendered content so
+    that clients may revalidate them with If-None-Match. There is no Last-Modified header, since the rendering
+    also depends on templates and contexts that may change at any time. A conditional request that misses the
+    cache still renders the email to compute its ETag.
     """
     def get(self, request, *args, **kwargs):
+        rendered_email = self.get_rendered_email()
+
+        # Respond with a 304 if the client already has this rendering of the email
+        response = get_conditional_response(request, etag=rendered_email['etag'])
+        if response is None:
+            response = HttpResponse(rendered_email['content'])
+
+        response['ETag'] = rendered_email['etag']
+        return response
+
+    def get_rendered_email(self):
+        """
+        Gets the rendered email from the cache if caching is enabled, rendering and caching it on a miss.
+        """
+        emailer_settings = get_emailer_settings()
+        timeout = emailer_settings['view_cache_timeout']
+        if not timeout:
+            return self.render_email()
+
+        cache = caches[emailer_settings['view_cache_alias']]
+        cache_key = 'entity_emailer.email.{0}'.format(self.args[0])
+        rendered_email = cache.get(cache_key)
+        if rendered_email is None:
+            rendered_email = self.render_email()
+            cache.set(cache_key, rendered_email, timeout)
+
+        return rendered_email
+
+    def render_email(self):
+        """
+        Renders the email and returns a dict of its content and the ETag of the content
+        """
         email = self.get_email()
         medium = get_medium()
         context_loader.load_contexts_and_renderers([email.event], [medium])
         txt, html = email.render(medium)
-        return HttpResponse(html if html else txt)
+        content = html if html else txt
+        return {
+            'content': content,
+            'etag': quote_etag(hashlib.sha1(content.encode('utf-8')).hexdigest()),
+        }
 
     def get_email(self):
-        return Email.objects.select_related('event').get(view_uid=self.args[0])
+        # The event source is needed to find the context renderers of the event
+        return Email.objects.select_related('event__source').get(view_uid=self.args[0])
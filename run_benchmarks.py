@@ -0,0 +1,213 @@
+"""
+Provides the ability to benchmark the email pipeline of a standalone Django app.
+
+Events, recipients and subscriptions are seeded into a test database at each scale and the time, number of
+queries and peak memory of converting the events to emails, sending the emails with the locmem backend and
+viewing the emails are reported as JSON so that runs may be compared across versions.
+"""
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from optparse import OptionParser
+from settings import configure_settings
+
+
+# Configure the default settings
+configure_settings()
+
+import django
+django.setup()
+
+# The models and fixtures must be imported here since they depend on the app registry being ready
+from django.core import mail
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client
+from django.test.runner import DiscoverRunner
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django_dynamic_fixture import G, N
+from entity.models import Entity, EntityKind
+from entity_event.models import ContextRenderer, Event, Medium, RenderingStyle, Source, Subscription
+
+from entity_emailer.interface import EntityEmailerInterface
+from entity_emailer.models import Email
+from entity_emailer.utils import clear_cache
+from entity_emailer.version import __version__
+
+
+def seed(num_events, num_recipients):
+    """
+    Creates the events of a source and the recipients that are subscribed to all of the emails of the source.
+    """
+    rendering_style = G(RenderingStyle, name='email')
+    medium = G(Medium, name='email', rendering_style=rendering_style)
+    source = G(Source)
+    G(
+        ContextRenderer, source=source, html_template_path='hi_template.html',
+        rendering_style=rendering_style, context_hints={
+            'entity': {
+                'app_name': 'entity',
+                'model_name': 'Entity',
+            }
+        })
+
+    entity_kind = G(EntityKind)
+    recipient = G(Entity, entity_kind=entity_kind, entity_meta={'email': 'recipient0@example.com'})
+    recipients = [recipient] + Entity.objects.bulk_create([
+        N(
+            Entity, entity_kind=entity_kind, entity_type=recipient.entity_type, entity_id=recipient.entity_id + i,
+            entity_meta={'email': 'recipient{0}@example.com'.format(i)},
+        )
+        for i in range(1, num_recipients)
+    ])
+    Subscription.objects.bulk_create([
+        N(Subscription, entity=recipient, source=source, medium=medium, only_following=False, sub_entity_kind=None)
+        for recipient in recipients
+    ])
+    Event.objects.bulk_create([
+        N(Event, source=source, context={'entity': recipients[i % num_recipients].id})
+        for i in range(num_events)
+    ])
+
+
+def measure(func):
+    """
+    Calls the function and returns its wall time and number of queries along with its result.
+    """
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        result = func()
+        wall_time = time.perf_counter() - start
+
+    return {
+        'wall_time': wall_time,
+        'queries': len(queries),
+    }, result
+
+
+def measure_memory(func):
+    """
+    Calls the function and returns its peak memory along with its result. Tracing slows down the function
+    several times over, so it is measured in a separate run from its wall time.
+    """
+    tracemalloc.start()
+    try:
+        result = func()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'peak_memory': peak_memory,
+    }, result
+
+
+def benchmark(name, func, trace_memory=False):
+    """
+    Measures a stage of the pipeline. The function returns the number of emails it handled.
+    """
+    if trace_memory:
+        results, num_emails = measure_memory(func)
+    else:
+        results, num_emails = measure(func)
+        results['emails_per_second'] = num_emails / results['wall_time'] if results['wall_time'] else None
+    results['emails'] = num_emails
+    sys.stderr.write('{0}: {1}\n'.format(name, json.dumps(results)))
+    return results
+
+
+def convert():
+    EntityEmailerInterface.bulk_convert_events_to_emails()
+    return Email.objects.count()
+
+
+def send():
+    EntityEmailerInterface.send_unsent_scheduled_emails()
+    return len(mail.outbox)
+
+
+def view(num_requests):
+    client = Client()
+    view_uids = Email.objects.values_list('view_uid', flat=True)[:num_requests]
+    for view_uid in view_uids:
+        client.get(reverse('entity_emailer.email', args=[view_uid]))
+    return len(view_uids)
+
+
+def run_stages(num_events, num_recipients, num_view_requests, trace_memory=False):
+    """
+    Seeds a fresh database and runs each stage of the pipeline on it
+    """
+    call_command('flush', interactive=False, verbosity=0)
+    clear_cache()
+    mail.outbox = []
+    seed(num_events, num_recipients)
+
+    return {
+        'bulk_convert_events_to_emails': benchmark('bulk_convert_events_to_emails', convert, trace_memory),
+        'send_unsent_scheduled_emails': benchmark('send_unsent_scheduled_emails', send, trace_memory),
+        'email_view': benchmark('email_view', lambda: view(num_view_requests), trace_memory),
+    }
+
+
+def run_scale(num_events, num_recipients, num_view_requests):
+    """
+    Times the stages in one run and measures their peak memory in another run from the same seed data
+    """
+    results = run_stages(num_events, num_recipients, num_view_requests)
+    memory_results = run_stages(num_events, num_recipients, num_view_requests, trace_memory=True)
+    for stage, stage_results in results.items():
+        stage_results['peak_memory'] = memory_results[stage]['peak_memory']
+
+    return dict(results, events=num_events, recipients=num_recipients)
+
+
+def run(scales, num_recipients, num_view_requests, output=None):
+    # Set up the locmem email backend and a test database
+    test_runner = DiscoverRunner(interactive=False, verbosity=0)
+    test_runner.setup_test_environment()
+    old_config = test_runner.setup_databases()
+
+    try:
+        results = {
+            'version': __version__,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'scales': [
+                run_scale(num_events, num_recipients, num_view_requests)
+                for num_events in scales
+            ],
+        }
+    finally:
+        test_runner.teardown_databases(old_config)
+        test_runner.teardown_test_environment()
+
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('--scales', dest='scales', action='store', default='100,1000', type=str,
+                      help='Comma separated numbers of events to benchmark')
+    parser.add_option('--recipients', dest='num_recipients', action='store', default=10, type=int,
+                      help='The number of recipients of each event')
+    parser.add_option('--view-requests', dest='num_view_requests', action='store', default=100, type=int,
+                      help='The number of emails to request from the email view')
+    parser.add_option('--output', dest='output', action='store', default=None, type=str,
+                      help='A file to write the JSON results to instead of stdout')
+    (options, args) = parser.parse_args()
+
+    run(
+        [int(scale) for scale in options.scales.split(',')],
+        options.num_recipients,
+        options.num_view_requests,
+        options.output,
+    )
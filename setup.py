@@ -61,6 +61,9 @@ setup(
     ],
     license='MIT',
     install_requires=get_requirements('requirements.txt'),
+    extras_require={
+        'async': ['aiosmtplib'],
+    },
     tests_require=get_requirements('requirements-testing.txt'),
     test_suite='run_tests.run',
     include_package_data=True,